@@ -22,11 +22,26 @@ RULES = []
 
 # Terminal charset
 TERMINAL_CHARSET = 'euc-jp'
+# Width of the East Asian "ambiguous" characters (1 or 2)
+AMBIGUOUS_CHAR_WIDTH = 2
 # Default message charset
 MESSAGE_CHARSET = 'iso-2022-jp'
 # Index yomi
 INDEX_YOMI = True
 
+# What to do with a message that is already in the database
+# when it is imported: 'skip', 'label' (as duplicate) or None.
+# Only messages with the same Message-ID and body are duplicates.
+DUPLICATE_ACTION = 'label'
+
+# Send messages in the foreground instead of queueing them to the outbox.
+SEND_SYNCHRONOUSLY = False
+# How long (in seconds) the outbox worker keeps connections after
+# the queue becomes empty.
+OUTBOX_IDLE = 30
+# Run the commands on the kernel server (server.py) when it is running.
+USE_KERNEL_SERVER = True
+
 # Colors
 COLOR4INFO = ''
 COLOR4WARNING = 'white+bg_red'
@@ -102,13 +117,46 @@ def quotemsg(from0, date0, subject0, lines):
     yield '> '+line
   return
 
+# Compiles the user settings. The code is cached in fname.cache
+# (just like a .pyc file) while the file is not changed.
+# The code has every string in the file (passwords included),
+# so the cache is readable only by the user.
+def _compile_rc(fname):
+  import marshal
+  st = os.stat(fname)
+  key = (sys.hexversion, st.st_mtime, st.st_size)
+  cachename = fname+'.cache'
+  try:
+    fp = file(cachename, 'rb')
+    try:
+      # A cache made readable by others is not used (and replaced).
+      if (not (os.fstat(fp.fileno()).st_mode & 0077) and
+          marshal.load(fp) == key):
+        return marshal.load(fp)
+    finally:
+      fp.close()
+  except (IOError, EOFError, ValueError, TypeError):
+    pass
+  fp = file(fname)
+  code = compile(fp.read(), fname, 'exec')
+  fp.close()
+  try:
+    tmpname = '%s.%d' % (cachename, os.getpid())
+    fd = os.open(tmpname, os.O_WRONLY|os.O_CREAT|os.O_TRUNC, 0600)
+    fp = os.fdopen(fd, 'wb')
+    marshal.dump(key, fp)
+    marshal.dump(code, fp)
+    fp.close()
+    os.rename(tmpname, cachename)
+  except (IOError, OSError):
+    pass
+  return code
+
 # Read user settings here.
 try:
   _fname = os.path.join(os.environ['HOME'], '.shalingrc')
-  _fp = file(_fname)
-  eval(compile(_fp.read(), _fname, 'exec'))
-  _fp.close()
-  del _fp, _fname
+  eval(_compile_rc(_fname))
+  del _fname
 except Exception, e:
   print >>sys.stderr, e
   print >>sys.stderr, 'shalinrc not found!'
@@ -124,6 +172,10 @@ INBOX_DIR = TOP_DIR and os.path.join(TOP_DIR, 'inbox')
 SELECTION_DIR = TOP_DIR and os.path.join(TOP_DIR, 'sel')
 TMP_DIR = TOP_DIR and os.path.join(TOP_DIR, 'tmp')
 LOG_FILE = TOP_DIR and os.path.join(TOP_DIR, 'log')
+POP3_DIR = TOP_DIR and os.path.join(TOP_DIR, 'pop3')
+OUTBOX_DIR = TOP_DIR and os.path.join(TOP_DIR, 'outbox')
+SERVER_SOCKET = TOP_DIR and os.path.join(TOP_DIR, 'server')
+RULES_CACHE = TOP_DIR and os.path.join(TOP_DIR, 'rules.cache')
 
 # Be verbose if the number of documents that are going
 # to be indexed is more than this:
@@ -139,14 +191,16 @@ LABEL4DELETED = '0'
 LABEL4SENT = '1'
 LABEL4DRAFT = '2'
 LABEL4READ = '3'
+LABEL4DUPLICATE = '8'
 LABEL4JUNK = '9'
-FILTERED_LABELS = set([LABEL4SENT, LABEL4DELETED, LABEL4JUNK])
+FILTERED_LABELS = set([LABEL4SENT, LABEL4DELETED, LABEL4DUPLICATE, LABEL4JUNK])
 
 LABELS.update({
   LABEL4READ: 'read',
   LABEL4DRAFT: 'draft',
   LABEL4SENT: 'sent',
   LABEL4DELETED: 'deleted',
+  LABEL4DUPLICATE: 'duplicate',
   LABEL4JUNK: 'junk',
   })
 
@@ -1,6 +1,12 @@
 #!/usr/bin/env python
 import sys, os, re, time, os.path
-from config import str2label
+try:
+  import cPickle as pickle
+except ImportError:
+  import pickle
+from collections import deque
+from config import str2label, LABELS, LABEL4DUPLICATE, POP3_DIR, RULES_CACHE
+from popclient import UIDState, AsyncPOP3Session
 from utils import get_message_date, unicode_header, unicode_getalladdrs
 stderr = sys.stderr
 
@@ -8,73 +14,205 @@ class RuleSetSyntaxError(ValueError): pass
 class PredicateSyntaxError(ValueError): pass
 class MessagePOP3Error(IOError): pass
 
+
+##  RuleContext
+##
+##  Holds the header values of a message so that they are
+##  extracted only once for all the rules.
+##
+class RuleContext:
+
+  def __init__(self, msg, engine=None):
+    self.msg = msg
+    self.engine = engine
+    self._addrs = {}
+    self._hits = {}
+    self._subject = None
+    self._subject_found = None
+    return
+
+  # Returns [(user, domain), ...] of the given fields.
+  def get_addrs(self, flds):
+    r = []
+    for f in flds:
+      if f not in self._addrs:
+        addrs = []
+        for (_,a) in unicode_getalladdrs(self.msg, f):
+          if '@' in a:
+            i = a.index('@')
+            addrs.append((a[:i].lower(), a[i+1:].lower()))
+          else:
+            addrs.append((a, '?'))
+        self._addrs[f] = addrs
+      r.extend(self._addrs[f])
+    return r
+
+  def get_subject(self):
+    if self._subject == None:
+      self._subject = unicode_header(self.msg['subject'])
+    return self._subject
+
+  # Returns the AddressPredicates that match the given fields.
+  def get_address_hits(self, flds):
+    if flds not in self._hits:
+      self._hits[flds] = self.engine.lookup_addrs(flds, self.get_addrs(flds))
+    return self._hits[flds]
+
+  # Returns False if none of the merged subject patterns can match.
+  def subject_found(self):
+    if self._subject_found == None:
+      s = self.get_subject()
+      self._subject_found = bool(s and self.engine.search_subject(s))
+    return self._subject_found
+
+
+##  RulePredicate
+##
+class RulePredicate:
+
+  def __call__(self, msg, labels):
+    return self.evaluate(RuleContext(msg), labels)
+
+  def evaluate(self, ctx, labels):
+    raise NotImplementedError
+
+class TruePredicate(RulePredicate):
+
+  def __repr__(self):
+    return '<TruePredicate>'
+
+  def evaluate(self, ctx, labels):
+    return True
+
+class Conjunction(RulePredicate):
+
+  def __init__(self, preds):
+    self.preds = preds
+    return
+
+  def __repr__(self):
+    return '<Conjunction: %r>' % (self.preds,)
+
+  def evaluate(self, ctx, labels):
+    for p in self.preds:
+      if not p.evaluate(ctx, labels): return False
+    return True
+
 # LabelPredicate
-def LabelPredicate(neg, name):
-  if name == '*':
-    if neg:
-      return (lambda msg, labels: not labels)
+class LabelPredicate(RulePredicate):
+
+  def __init__(self, neg, name):
+    self.neg = neg
+    self.name = name
+    if name == '*':
+      self.label = None
     else:
-      return (lambda msg, labels: labels)
-  try:
-    label = str2label(name)
-  except KeyError:
-    raise PredicateSyntaxError('Unknown label: %s' % name)
-  if neg:
-    return (lambda msg, labels: label not in labels)
-  else:
-    return (lambda msg, labels: label in labels)
+      try:
+        self.label = str2label(name)
+      except KeyError:
+        raise PredicateSyntaxError('Unknown label: %s' % name)
+    return
+
+  def __repr__(self):
+    return '<LabelPredicate: neg=%r, name=%r>' % (self.neg, self.name)
+
+  def evaluate(self, ctx, labels):
+    if self.label == None:
+      if self.neg:
+        return not labels
+      else:
+        return labels
+    if self.neg:
+      return self.label not in labels
+    else:
+      return self.label in labels
 
 # DatePredicate:
-def DatePredicate(neg, s):
-  if s == 'future':
-    t0 = -sys.maxint
-    t1 = -3600
-  elif s == 'today':
-    t0 = 0
-    t1 = 86400
-  if neg:
-    def func1(msg, labels):
-      t = time.time()-get_message_date(msg)
-      return not (t0 <= t and t <= t1)
-    return func1
-  else:
-    def func2(msg, labels):
-      t = time.time()-get_message_date(msg)
-      return t0 <= t and t <= t1
-    return func2
+class DatePredicate(RulePredicate):
+
+  def __init__(self, neg, s):
+    self.neg = neg
+    self.s = s
+    if s == 'future':
+      (self.t0, self.t1) = (-sys.maxint, -3600)
+    elif s == 'today':
+      (self.t0, self.t1) = (0, 86400)
+    else:
+      raise PredicateSyntaxError('Unknown date: %s' % s)
+    return
+
+  def __repr__(self):
+    return '<DatePredicate: neg=%r, s=%r>' % (self.neg, self.s)
+
+  def evaluate(self, ctx, labels):
+    t = time.time()-get_message_date(ctx.msg)
+    if self.neg:
+      return not (self.t0 <= t and t <= self.t1)
+    else:
+      return self.t0 <= t and t <= self.t1
 
 # SubjectPredicate
-def SubjectPredicate(neg, subj):
-  pat = re.compile(subj, re.I)
-  def func(msg, labels):
-    s = unicode_header(msg['subject'])
-    return s and pat.search(s)
-  return func
+class SubjectPredicate(RulePredicate):
+
+  # Patterns with these cannot be merged into one alternation.
+  UNMERGEABLE = re.compile(r'\\\d|\(\?')
+
+  def __init__(self, neg, subj):
+    self.neg = neg
+    self.subj = subj
+    self.pat = re.compile(subj, re.I)
+    self.mergeable = not self.UNMERGEABLE.search(subj)
+    return
+
+  def __repr__(self):
+    return '<SubjectPredicate: subj=%r>' % self.subj
+
+  def evaluate(self, ctx, labels):
+    # (The negation is not supported.)
+    if (self.mergeable and ctx.engine and ctx.engine.subject_pats and
+        not ctx.subject_found()):
+      return False
+    s = ctx.get_subject()
+    return s and self.pat.search(s)
 
 # AddressPredicate
-def AddressPredicate(neg, addr, *flds):
+class AddressPredicate(RulePredicate):
   # abc@def
   # abc@
   # abc
   # @def
   # @*def
-  i = addr.index('@')
-  user0 = str(addr[:i].lower())
-  domain0 = str(addr[i+1:].lower())
-  def func(msg, labels):
-    for (_,a) in unicode_getalladdrs(msg, *flds):
-      if '@' in a:
-        i = a.index('@')
-        (user,domain) = (a[:i].lower(), a[i+1:].lower())
-      else:
-        (user,domain) = (a, '?')
-      if user0 and user0 != user: continue
-      if (not domain0 or domain0 == domain or 
-          domain0.startswith('*') and domain.endswith(domain0[1:])):
-        return not neg
-    return neg
-  
-  return func
+
+  def __init__(self, neg, addr, *flds):
+    i = addr.index('@')
+    self.neg = neg
+    self.addr = addr
+    self.flds = flds
+    self.user0 = str(addr[:i].lower())
+    self.domain0 = str(addr[i+1:].lower())
+    return
+
+  def __repr__(self):
+    return '<AddressPredicate: neg=%r, addr=%r, flds=%r>' % (self.neg, self.addr, self.flds)
+
+  def match1(self, user, domain):
+    if self.user0 and self.user0 != user: return False
+    domain0 = self.domain0
+    return (not domain0 or domain0 == domain or
+            domain0.startswith('*') and domain.endswith(domain0[1:]))
+
+  def evaluate(self, ctx, labels):
+    if ctx.engine:
+      found = self in ctx.get_address_hits(self.flds)
+    else:
+      found = False
+      for (user,domain) in ctx.get_addrs(self.flds):
+        if self.match1(user, domain):
+          found = True
+          break
+    if found:
+      return not self.neg
+    return self.neg
 
 # FromPredicate
 def FromPredicate(neg, addr):
@@ -111,18 +249,214 @@ def parse_predicate1(s):
   return factory(neg, arg)
 
 
+##  AddressTable
+##
+##  AddressPredicates indexed by exact address, user and domain.
+##
+class AddressTable:
+
+  def __init__(self):
+    self.exact = {}
+    self.users = {}
+    self.domains = {}
+    self.suffixes = {}
+    self.anys = []
+    return
+
+  def add(self, pred):
+    (user0, domain0) = (pred.user0, pred.domain0)
+    if domain0.startswith('*'):
+      self.suffixes.setdefault((user0, domain0[1:]), []).append(pred)
+    elif user0 and domain0:
+      self.exact.setdefault((user0, domain0), []).append(pred)
+    elif user0:
+      self.users.setdefault(user0, []).append(pred)
+    elif domain0:
+      self.domains.setdefault(domain0, []).append(pred)
+    else:
+      self.anys.append(pred)
+    return
+
+  def lookup(self, addrs):
+    hits = set()
+    for (user,domain) in addrs:
+      hits.update(self.exact.get((user,domain), ()))
+      hits.update(self.users.get(user, ()))
+      hits.update(self.domains.get(domain, ()))
+      if self.suffixes:
+        for i in xrange(len(domain)+1):
+          suffix = domain[i:]
+          hits.update(self.suffixes.get((user,suffix), ()))
+          hits.update(self.suffixes.get(('',suffix), ()))
+      hits.update(self.anys)
+    return hits
+
+
+##  RuleEngine
+##
+##  Compiled form of the rules: address predicates are looked up
+##  through hash tables and subject patterns are prefiltered by
+##  a few merged regexps.
+##
+class RuleEngine:
+
+  MAX_GROUPS = 99
+
+  def __init__(self, rules):
+    self.tables = {}
+    subjs = []
+    def walk(pred):
+      if isinstance(pred, Conjunction):
+        for p in pred.preds:
+          walk(p)
+      elif isinstance(pred, AddressPredicate):
+        if pred.flds not in self.tables:
+          self.tables[pred.flds] = AddressTable()
+        self.tables[pred.flds].add(pred)
+      elif isinstance(pred, SubjectPredicate):
+        if pred.mergeable:
+          subjs.append(pred)
+      return
+    for (pred, _, _) in rules:
+      walk(pred)
+    # The subject patterns are merged into alternations of
+    # less than MAX_GROUPS groups each (a limit of sre).
+    self.subject_pats = []
+    chunk = []
+    ngroups = 0
+    for pred in subjs+[None]:
+      if chunk and (pred == None or self.MAX_GROUPS <= ngroups+pred.pat.groups):
+        try:
+          self.subject_pats.append(
+            re.compile(u'|'.join( u'(?:%s)' % p.subj for p in chunk ), re.I))
+        except (re.error, AssertionError):
+          # Every pattern is tried by itself.
+          self.subject_pats = []
+          break
+        chunk = []
+        ngroups = 0
+      if pred != None:
+        chunk.append(pred)
+        ngroups += pred.pat.groups
+    return
+
+  def __repr__(self):
+    return '<RuleEngine: tables=%r>' % (self.tables.keys(),)
+
+  def lookup_addrs(self, flds, addrs):
+    return self.tables[flds].lookup(addrs)
+
+  def search_subject(self, s):
+    for pat in self.subject_pats:
+      if pat.search(s): return True
+    return False
+
+
+##  RuleCache
+##
+##  Parsed rule files kept in RULES_CACHE. An entry is used while
+##  the file has the same mtime and size (or the same contents)
+##  and the label names are not changed.
+##
+class RuleCache:
+
+  # The entries are pickled predicate objects: change this
+  # whenever the rule classes are changed.
+  FORMAT = 1
+
+  _instance = None
+
+  @classmethod
+  def get_instance(klass):
+    if klass._instance == None:
+      klass._instance = klass(RULES_CACHE)
+    return klass._instance
+
+  def __init__(self, fname):
+    self.fname = fname
+    self.entries = None
+    self.labels = sorted(LABELS.iteritems())
+    return
+
+  def __repr__(self):
+    return '<RuleCache: fname=%r>' % self.fname
+
+  def load(self):
+    self.entries = {}
+    if not self.fname: return
+    try:
+      fp = file(self.fname, 'rb')
+    except IOError:
+      return
+    try:
+      try:
+        # The entries are read only when the key matches.
+        if pickle.load(fp) == (self.FORMAT, self.labels):
+          self.entries = pickle.load(fp)
+      except Exception:
+        # Broken or made by an incompatible version.
+        pass
+    finally:
+      fp.close()
+    return
+
+  def save(self):
+    if not self.fname: return
+    tmpname = '%s.%d' % (self.fname, os.getpid())
+    try:
+      fp = file(tmpname, 'wb')
+      pickle.dump((self.FORMAT, self.labels), fp, 2)
+      pickle.dump(self.entries, fp, 2)
+      fp.close()
+      os.rename(tmpname, self.fname)
+    except (IOError, OSError):
+      pass
+    return
+
+  def get(self, fname):
+    if self.entries == None:
+      self.load()
+    fname = os.path.abspath(fname)
+    if fname not in self.entries: return None
+    (mtime, size, digest, rules) = self.entries[fname]
+    st = os.stat(fname)
+    if (st.st_mtime, st.st_size) == (mtime, size): return rules
+    # The timestamp is changed: compare the contents.
+    fp = file(fname)
+    data = fp.read()
+    fp.close()
+    if get_digest(data) != digest: return None
+    self.entries[fname] = (st.st_mtime, st.st_size, digest, rules)
+    self.save()
+    return rules
+
+  def put(self, fname, data, rules):
+    if self.entries == None:
+      self.load()
+    fname = os.path.abspath(fname)
+    st = os.stat(fname)
+    self.entries[fname] = (st.st_mtime, st.st_size, get_digest(data), rules)
+    self.save()
+    return
+
+def get_digest(data):
+  import hashlib
+  return hashlib.md5(data).digest()
+
+
 ##  RuleSet
 ##
 class RuleSet:
 
   def __init__(self, args, labels=None):
     self.rules = []
+    self.engine = None
     if labels:
       try:
         labels = ''.join( str2label(x.strip()) for x in labels )
       except KeyError, e:
         raise RuleSetSyntaxError('Unknown label: %s' % e)
-      self.rules.append((lambda a,b:True, labels, False))
+      self.rules.append((TruePredicate(), labels, False))
     for fname in args:
       self.read(fname)
     return
@@ -137,11 +471,24 @@ class RuleSet:
 
   # read_rules
   def read(self, fname):
-    fp = file(fname)
+    cache = RuleCache.get_instance()
+    rules = cache.get(fname)
+    if rules == None:
+      fp = file(fname)
+      data = fp.read()
+      fp.close()
+      rules = self.parse(fname, data.splitlines(True))
+      cache.put(fname, data, rules)
+    self.rules.extend(rules)
+    self.engine = None
+    return self
+
+  def parse(self, fname, lines):
+    rules = []
     preds = []
 
     labelstr = ''
-    for (lineno,line) in enumerate(fp.xreadlines()):
+    for (lineno,line) in enumerate(lines):
       def add1(preds, s):
         if s.endswith('!'):
           terminate = True
@@ -156,12 +503,7 @@ class RuleSet:
         if len(preds) == 1:
           pred = preds[0]
         else:
-          # closure
-          def conj(msg, labels):
-            for p in preds:
-              if not p(msg, labels): return False
-            return True
-          pred = conj
+          pred = Conjunction(preds)
         return (pred, assign, terminate)
 
       # Strip comments.
@@ -170,7 +512,7 @@ class RuleSet:
       if line.startswith('[') and line.endswith(']'):
         # Label spec.
         if labelstr and preds:
-          self.rules.append(add1(preds, labelstr))
+          rules.append(add1(preds, labelstr))
         labelstr = line[1:-1].strip()
         preds = []
       else:
@@ -181,14 +523,17 @@ class RuleSet:
           raise RuleSetSyntaxError('Syntax Error: %s: line %d in %r.' % (e, lineno, fname))
         preds.append(pred1)
     if labelstr and preds:
-      self.rules.append(add1(preds, labelstr))
-    return self
+      rules.append(add1(preds, labelstr))
+    return rules
 
   # apply_rules
   def apply_msg(self, msg, debug=0):
+    if not self.engine:
+      self.engine = RuleEngine(self.rules)
+    ctx = RuleContext(msg, self.engine)
     labels = ''
     for (pred, label1, terminate) in self.rules:
-      if pred(msg, labels):
+      if pred.evaluate(ctx, labels):
         labels += label1
         if debug:
           print >>stderr, 'applied: %r: labels=%r' % (pred, labels)
@@ -196,6 +541,228 @@ class RuleSet:
     return ''.join(sorted(set(labels)))
     
 
+##  ImportPipeline
+##
+##  Messages from an importer are compressed by worker threads
+##  while a single writer (the caller) appends them to the corpus
+##  in the original order. zlib releases the GIL while compressing,
+##  so the workers can run on several cores. The number of messages
+##  in the pipeline never exceeds max_pending.
+##  A message that is already in the corpus is skipped or labeled
+##  as a duplicate, depending on dup_action ('skip' or 'label').
+##
+class ImportPipeline:
+
+  NWORKERS = 2
+  MAX_PENDING = 64
+
+  def __init__(self, corpus, nworkers=None, max_pending=MAX_PENDING,
+               dup_action=None):
+    if not nworkers:
+      try:
+        from multiprocessing import cpu_count
+        nworkers = cpu_count()
+      except (ImportError, NotImplementedError):
+        nworkers = self.NWORKERS
+    self.corpus = corpus
+    self.nworkers = nworkers
+    self.max_pending = max_pending
+    self.dup_action = dup_action
+    return
+
+  def __repr__(self):
+    return '<ImportPipeline: corpus=%r, nworkers=%d, max_pending=%d>' % \
+           (self.corpus, self.nworkers, self.max_pending)
+
+  def run(self, msgs):
+    '''
+    msgs: an iterator of (data, labels, mtime) in chronological order.
+    Yields the loc of each message after it is added,
+    or None if the message is skipped as a duplicate.
+    '''
+    import threading, Queue
+    slots = threading.Semaphore(self.max_pending)
+    stopped = threading.Event()
+    inq = Queue.Queue()
+    outq = Queue.Queue()
+
+    # Reader: runs the importer (retrieval, parsing and rules).
+    def reader():
+      seqno = 0
+      try:
+        for (data, labels, mtime) in msgs:
+          slots.acquire()
+          if stopped.isSet(): break
+          inq.put((seqno, data, labels, mtime))
+          seqno += 1
+        outq.put(('end', seqno))
+      except Exception:
+        outq.put(('error', sys.exc_info()))
+      for _ in xrange(self.nworkers):
+        inq.put(None)
+      return
+
+    # Workers: compress the messages.
+    def worker():
+      while 1:
+        item = inq.get()
+        if item == None: break
+        (seqno, data, labels, mtime) = item
+        try:
+          prepared = self.corpus.prepare_message(data)
+        except Exception:
+          outq.put(('error', sys.exc_info()))
+          continue
+        outq.put(('msg', (seqno, prepared, labels, mtime)))
+      return
+
+    threads = [ threading.Thread(target=reader) ]
+    threads.extend( threading.Thread(target=worker) for _ in xrange(self.nworkers) )
+    for t in threads:
+      t.setDaemon(True)
+      t.start()
+
+    # Writer: appends the messages in order.
+    pending = {}
+    seqno = 0
+    total = None
+    try:
+      while total == None or seqno < total:
+        try:
+          # (A timeout keeps the wait interruptible.)
+          (kind, x) = outq.get(True, 1.0)
+        except Queue.Empty:
+          continue
+        if kind == 'error':
+          raise x[0], x[1], x[2]
+        if kind == 'end':
+          total = x
+          continue
+        pending[x[0]] = x[1:]
+        while seqno in pending:
+          (prepared, labels, mtime) = pending.pop(seqno)
+          if self.dup_action and self.corpus.find_duplicate(prepared) != None:
+            if self.dup_action == 'skip':
+              loc = None
+            else:
+              loc = self.corpus.add_prepared_message(
+                prepared, list(labels)+[LABEL4DUPLICATE], mtime)
+          else:
+            loc = self.corpus.add_prepared_message(prepared, labels, mtime)
+          yield loc
+          seqno += 1
+          slots.release()
+    finally:
+      stopped.set()
+      slots.release()
+    return
+
+
+##  SpoolMerger
+##
+##  Reads several spools at once (one thread per spool) and merges
+##  their messages into one chronological stream. commit() must be
+##  called after each message is added; a spool is closed (and
+##  cleaned up) as soon as all of its messages are committed.
+##
+class SpoolMerger:
+
+  MAX_PENDING = 16
+
+  def __init__(self, importers, cleanup=False):
+    self.importers = importers
+    self.cleanup = cleanup
+    n = len(importers)
+    # npassed is only updated by the merging thread and
+    # ncommitted only by the writer.
+    self.npassed = [0]*n
+    self.ncommitted = [0]*n
+    self.finished = [False]*n
+    self.closed = [False]*n
+    self._order = deque()
+    return
+
+  def __repr__(self):
+    return '<SpoolMerger: importers=%r, cleanup=%r>' % (self.importers, self.cleanup)
+
+  def __iter__(self):
+    import threading, Queue, heapq
+    stopped = threading.Event()
+
+    # Each spool is read by its own thread.
+    def reader(imp, q):
+      try:
+        imp.read_messages()
+        if not imp.is_empty():
+          for item in imp.finish():
+            while not stopped.isSet():
+              try:
+                q.put(('msg', item), True, 1.0)
+                break
+              except Queue.Full:
+                pass
+            if stopped.isSet(): return
+        q.put(('end', None))
+      except Exception:
+        q.put(('error', sys.exc_info()))
+      return
+
+    def iter_spool(i, q):
+      seq = 0
+      while 1:
+        try:
+          (kind, x) = q.get(True, 1.0)
+        except Queue.Empty:
+          continue
+        if kind == 'error':
+          raise x[0], x[1], x[2]
+        if kind == 'end': break
+        (data, labels, mtime) = x
+        yield (mtime, i, seq, data, labels)
+        seq += 1
+      self.finished[i] = True
+      return
+
+    streams = []
+    for (i,imp) in enumerate(self.importers):
+      q = Queue.Queue(self.MAX_PENDING)
+      t = threading.Thread(target=reader, args=(imp, q))
+      t.setDaemon(True)
+      t.start()
+      streams.append(iter_spool(i, q))
+    try:
+      for (mtime, i, _, data, labels) in heapq.merge(*streams):
+        self.npassed[i] += 1
+        self._order.append(i)
+        yield (data, labels, mtime)
+    finally:
+      stopped.set()
+    return
+
+  def commit(self):
+    i = self._order.popleft()
+    self.ncommitted[i] += 1
+    self.close_finished()
+    return
+
+  def close_finished(self):
+    for (i,imp) in enumerate(self.importers):
+      if (not self.closed[i] and self.finished[i] and
+          self.npassed[i] == self.ncommitted[i]):
+        self.closed[i] = True
+        imp.close(self.cleanup)
+    return
+
+  def close(self):
+    # Spools that are not entirely committed are left intact.
+    self.close_finished()
+    for (i,imp) in enumerate(self.importers):
+      if not self.closed[i]:
+        self.closed[i] = True
+        imp.abort(self.ncommitted[i])
+    return
+
+
 ##  MessageImporter
 ##
 ##  A MessageImporter is responsible for retrieving email messages
@@ -215,47 +782,107 @@ class MessageImporter:
   def close(self, cleanup=False):
     raise NotImplementedError
 
+  # abort: called instead of close() when not all the messages
+  # have been committed (only the first ncommitted ones are).
+  def abort(self, ncommitted=0):
+    return self.close(False)
+
 
 ##  MaildirImporter
 ##
 class MaildirImporter(MessageImporter):
 
-  def __init__(self, dirname, ruleset=None):
+  # Messages are sorted in chunks of this size and spilled to
+  # temporary files, which are merged when the spool is imported.
+  CHUNKSIZE = 10000
+
+  def __init__(self, dirname, ruleset=None, chunksize=CHUNKSIZE):
     if not os.path.isdir(dirname):
       raise IOError('Directory does not exist: %r' % dirname)
     self.dirname = dirname
     self.ruleset = ruleset
-    self.msgs = []
+    self.chunksize = chunksize
+    self.nmsgs = 0
+    self._chunks = []
+    self._msgs = []
     return
 
   def __repr__(self):
-    return '<MaildirImporter: dirname=%r, ruleset=%r, msgs=%d>' % (self.dirname, self.ruleset, len(self.msgs))
+    return '<MaildirImporter: dirname=%r, ruleset=%r, msgs=%d>' % (self.dirname, self.ruleset, self.nmsgs)
 
   def is_empty(self):
-    return not self.msgs
+    return not self.nmsgs
+
+  # list_files: yields every message file in the spool.
+  # A maildir with cur/ and new/ subdirectories is also accepted.
+  def list_files(self):
+    try:
+      from scandir import scandir
+    except ImportError:
+      scandir = None
+    dirnames = [ os.path.join(self.dirname, x) for x in ('cur', 'new') ]
+    dirnames = [ x for x in dirnames if os.path.isdir(x) ] or [self.dirname]
+    for dirname in dirnames:
+      if scandir:
+        for ent in scandir(dirname):
+          if ent.name.startswith('.') or not ent.is_file(): continue
+          yield ent.path
+      else:
+        for fname in os.listdir(dirname):
+          if fname.startswith('.'): continue
+          fname = os.path.join(dirname, fname)
+          if not os.path.isfile(fname): continue
+          yield fname
+    return
 
   def read_messages(self):
     from email import Parser
-    for fname in os.listdir(self.dirname):
-      if fname.startswith('.'): continue
-      fname = os.path.join(self.dirname, fname)
+    for fname in self.list_files():
       fp = file(fname, 'rb')
       p = Parser.FeedParser()
       for line in fp:
         p.feed(line)
         if not line.strip(): break
+      fp.close()
       msg = p.close()
       if self.ruleset:
         labels = self.ruleset.apply_msg(msg)
       else:
         labels = []
-      self.msgs.append((fname, labels, get_message_date(msg)))
+      self._msgs.append((get_message_date(msg), ''.join(labels), fname))
+      self.nmsgs += 1
+      if self.chunksize <= len(self._msgs):
+        self._spill()
+    self._msgs.sort()
+    return
+
+  # _spill: writes the sorted messages to a temporary file.
+  # The filenames are escaped, as they can contain any character
+  # (including tabs and newlines).
+  def _spill(self):
+    import tempfile
+    self._msgs.sort()
+    fp = tempfile.TemporaryFile()
+    for (mtime, labels, fname) in self._msgs:
+      fp.write('%d\t%s\t%s\n' % (mtime, labels, fname.encode('string_escape')))
+    self._chunks.append(fp)
+    self._msgs = []
     return
 
+  # _iter_msgs: yields (mtime, labels, fname) in chronological order.
+  def _iter_msgs(self):
+    import heapq
+    def iter_chunk(fp):
+      fp.seek(0)
+      for line in fp:
+        (mtime, labels, fname) = line[:-1].split('\t', 2)
+        yield (int(mtime), labels, fname.decode('string_escape'))
+      return
+    return heapq.merge(iter(self._msgs), *[ iter_chunk(fp) for fp in self._chunks ])
+
   def finish(self):
-    self.msgs.sort(key=lambda (fname,label,mtime): mtime)
-    for (loc, labels, mtime) in self.msgs:
-      fp = file(loc)
+    for (mtime, labels, fname) in self._iter_msgs():
+      fp = file(fname)
       data = fp.read()
       fp.close()
       yield (data, labels, mtime)
@@ -263,8 +890,12 @@ class MaildirImporter(MessageImporter):
 
   def close(self, cleanup=False):
     if cleanup:
-      for (loc, labels, mtime) in self.msgs:
-        os.unlink(loc)
+      for (mtime, labels, fname) in self._iter_msgs():
+        os.unlink(fname)
+    for fp in self._chunks:
+      fp.close()
+    self._chunks = []
+    self._msgs = []
     return
 
 
@@ -286,23 +917,56 @@ class MboxImporter(MessageImporter):
   def read_messages(self):
     return
   
+  # Yields (start, end) of each message in a mapped mbox.
+  # Every line that starts with "From " is a separator.
+  @staticmethod
+  def split_mbox(mm):
+    if mm[:5] == 'From ':
+      start = 0
+    else:
+      start = mm.find('\nFrom ')
+      if start < 0: return
+      start += 1
+    size = len(mm)
+    while start < size:
+      end = mm.find('\nFrom ', start)
+      if end < 0:
+        end = size
+      else:
+        end += 1
+      yield (start, end)
+      start = end
+    return
+
+  HEADER_END = re.compile(r'\r?\n\r?\n')
   def finish(self):
-    from mailbox import PortableUnixMailbox
+    import mmap
     from email import Parser
     try:
       fp = file(self.fname, 'rb')
     except IOError:
       return
-    for data in PortableUnixMailbox(fp, lambda msgfp: msgfp.read()):
-      p = Parser.FeedParser()
-      p.feed(data)
-      msg = p.close()
+    try:
+      mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    except (mmap.error, ValueError):
+      # empty file
+      fp.close()
+      return
+    # The mapping stays valid after the file is closed.
+    fp.close()
+    for (start, end) in self.split_mbox(mm):
+      # Parse only the headers.
+      m = self.HEADER_END.search(mm, start, end)
+      if m:
+        header = mm[start:m.end(0)]
+      else:
+        header = mm[start:end]
+      msg = Parser.HeaderParser().parsestr(header)
       if self.ruleset:
         labels = self.ruleset.apply_msg(msg)
       else:
         labels = []
-      yield (data, labels, get_message_date(msg))
-    fp.close()
+      yield (mm[start:end], labels, get_message_date(msg))
     return
   
   def close(self, cleanup=False):
@@ -314,98 +978,264 @@ class MboxImporter(MessageImporter):
     return
 
  
-##  POP3Importer
-##  Contributed by Yasusi Iwata.
+##  AsyncPOP3Importer
 ##
-class POP3Importer(MessageImporter):
+##  Fetches several POP3/POP3S mailboxes on one asyncore loop.
+##  Messages are parsed while the other sessions keep receiving,
+##  so no mailbox waits for another. A mailbox that fails (or
+##  does not respond for AsyncPOP3Session.TIMEOUT seconds) is
+##  given up; the others are fetched and then the error is raised.
+##
+class AsyncPOP3Importer(MessageImporter):
+
+  POLL_INTERVAL = 0.1
 
-  def __init__(self, hostname, username, password, port=110, ruleset=None):
-    self.hostname = hostname
-    self.username = username
-    self.password = password
-    self.port = port
+  def __init__(self, accounts, ruleset=None):
+    '''
+    accounts: [(hostname, port, username, password, use_ssl), ...]
+    '''
+    self.accounts = accounts
     self.ruleset = ruleset
-    self.msgcount = 0
-    self.server = None   
+    self.map = {}
+    self.sessions = []
+    self.fetched = []
     return
 
   def __repr__(self):
-    return '<POP3Importer: hostname=%r, username=%r, password=%r, port=%r, ruleset=%r, msgcount=%r, server=%r>' % (self.hostname, self.username, self.password, self.port, self.ruleset, self.msgcount, self.server)
+    return '<AsyncPOP3Importer: accounts=%r, ruleset=%r, sessions=%r>' % \
+           ([ a[:3] for a in self.accounts ], self.ruleset, self.sessions)
 
   def is_empty(self):
-    return not self.msgcount
-  
+    # (A failed session is reported by finish().)
+    return not any( session.get_unseen() or session.received or session.error
+                    for session in self.sessions )
+
+  def _poll(self):
+    import asyncore
+    t0 = time.time()
+    asyncore.loop(self.POLL_INTERVAL, map=self.map, count=1)
+    elapsed = time.time()-t0
+    for session in self.sessions:
+      session.check_timeout(elapsed)
+    return
+
   def read_messages(self):
-    import poplib
-    try:
-      self.server = poplib.POP3(self.hostname, self.port)
-      if self.server.timestamp.match(self.server.welcome):
-        # APOP login
-        self.server.apop(self.username, self.password)
-      else:
-        # plain text login
-        self.server.user(self.username)
-        self.server.pass_(self.password)
-      self.msgcount = len(self.server.list()[1])
-    except poplib.error_proto, e:
-      raise MessagePOP3Error(str(e))
+    # Logs in and lists every mailbox at once.
+    for (hostname, port, username, password, use_ssl) in self.accounts:
+      statefile = get_pop3_statefile(hostname, username)
+      state = statefile and UIDState(statefile)
+      self.sessions.append(AsyncPOP3Session(
+        hostname, port, username, password, state, use_ssl, self.map))
+    while not all( session.ready or session.finished for session in self.sessions ):
+      self._poll()
     return
-  
+
   def finish(self):
-    import poplib
     from email import Parser
-    for i in xrange(self.msgcount):
-      try:
-        data = self.server.retr(i+1)[1]
-      except poplib.error_proto, e:
-        raise MessagePOP3Error(str(e))
-      data = '\r\n'.join(data)
-      p = Parser.FeedParser()
-      p.feed(data)
-      msg = p.close()
-      if self.ruleset:
-        labels = self.ruleset.apply_msg(msg)
-      else:
-        labels = []
-      yield (data, labels, get_message_date(msg))
+    while 1:
+      for session in self.sessions:
+        for (uid,data) in session.get_messages():
+          msg = Parser.HeaderParser().parsestr(data)
+          if self.ruleset:
+            labels = self.ruleset.apply_msg(msg)
+          else:
+            labels = []
+          self.fetched.append((session, uid))
+          yield (data, labels, get_message_date(msg))
+      if all( session.finished for session in self.sessions ): break
+      self._poll()
+    errors = [ '%s: %s' % (session.hostname, session.error or 'error')
+               for session in self.sessions if session.error ]
+    if errors:
+      raise MessagePOP3Error(', '.join(errors))
     return
-  
+
   def close(self, cleanup=False):
-    if self.server:
-      if cleanup:
-        for i in xrange(self.msgcount):
-          self.server.dele(i+1)
-      self.server.quit()
-      self.server = None
-      self.msgcount = 0
+    for (session,uid) in self.fetched:
+      if session.state and uid != None:
+        session.state.add(uid)
+    for session in self.sessions:
+      if session.state:
+        if not session.error and session.uids != None:
+          session.state.prune( uid for (_,uid) in session.uids )
+        session.state.save()
+      if not session.error:
+        session.quit(cleanup)
+    while self.map:
+      self._poll()
+    self.sessions = []
+    self.fetched = []
     return
 
-##  POP3SSLImporter
-##
-class POP3SSLImporter(POP3Importer):
+  def abort(self, ncommitted=0):
+    # Only the committed messages are remembered.
+    self.fetched = self.fetched[:ncommitted]
+    return self.close(False)
 
-  def __init__(self, hostname, username, password, port='995', ruleset=None):
-    POP3Importer.__init__(self, hostname, username, password, port, ruleset)
+# get_pop3_statefile: returns the file that keeps the UIDs
+# fetched from a POP3 mailbox.
+def get_pop3_statefile(hostname, username):
+  if not POP3_DIR: return None
+  return os.path.join(POP3_DIR, ('%s@%s' % (username, hostname)).replace(os.path.sep, '_'))
 
-  def read_messages(self):
-    import poplib
+# parse_pop3_spool: returns (hostname, port, username, password, use_ssl)
+# for 'pop3:hostname[:port],username,password' (or 'pop3ssl:...').
+def parse_pop3_spool(spool):
+  if spool.startswith('pop3:'):
+    (spec, port, use_ssl) = (spool[5:], 110, False)
+  elif spool.startswith('pop3ssl:'):
+    (spec, port, use_ssl) = (spool[8:], 995, True)
+  else:
+    return None
+  (hostname, username, password) = spec.split(',', 2)
+  if ':' in hostname:
+    (hostname, port) = hostname.split(':', 1)
     try:
-      self.server = poplib.POP3_SSL(self.hostname, self.port)
-      self.server.user(self.username)
-      self.server.pass_(self.password)
-      self.msgcount = len(self.server.list()[1])
-    except poplib.error_proto, e:
-      raise MessagePOP3Error(str(e))
-    return
+      port = int(port)
+    except ValueError:
+      raise MessagePOP3Error('Invalid port: %r' % spool)
+  return (hostname, port, username, password, use_ssl)
 
 def CreateMessageImporter(spool, ruleset=None):
   if spool.endswith('/'):
     return MaildirImporter(spool, ruleset)
-  elif spool.startswith('pop3:'):
-    hostname, username, password = spool[5:].split(',')
-    return POP3Importer(hostname, username, password, ruleset=ruleset)
-  elif spool.startswith('pop3ssl:'):
-    hostname, username, password = spool[8:].split(',')
-    return POP3SSLImporter(hostname, username, password, ruleset=ruleset)
-  else:
-    return MboxImporter(spool, ruleset)
+  account = parse_pop3_spool(spool)
+  if account:
+    return AsyncPOP3Importer([account], ruleset)
+  return MboxImporter(spool, ruleset)
+
+# CreateMessageImporters: returns the importers for the given spools.
+# The POP3 spools are fetched together by one AsyncPOP3Importer.
+def CreateMessageImporters(spools, ruleset=None):
+  importers = []
+  accounts = []
+  for spool in spools:
+    account = parse_pop3_spool(spool)
+    if account:
+      accounts.append(account)
+    else:
+      importers.append(CreateMessageImporter(spool, ruleset))
+  if accounts:
+    importers.append(AsyncPOP3Importer(accounts, ruleset))
+  return importers
+
+
+# unittests
+if __name__ == '__main__':
+  import unittest, tempfile, shutil, gzip, StringIO
+
+  MBOX = ('From a@b Mon Jan  1 00:00:00 2007\n'
+          'Subject: 1\nMessage-ID: <1@b>\n\nbody\n\n'
+          'From c@d Tue Jan  2 00:00:00 2007\n'
+          'Subject: 2\nContent-Type: multipart/mixed; boundary="XX"\n\n'
+          '--XX\nContent-Type: text/html\n\n<p>\n'
+          '--XX\nContent-Type: image/png\nContent-Disposition: attachment\n\npng\n'
+          '--XX--\n\n'
+          'From e@f Wed Jan  3 00:00:00 2007\n'
+          'Subject: 3\n\n\n')
+
+  class MboxImporterTest(unittest.TestCase):
+
+    def setUp(self):
+      self.dirname = tempfile.mkdtemp()
+      self.fname = os.path.join(self.dirname, 'mbox')
+      fp = file(self.fname, 'wb')
+      fp.write(MBOX)
+      fp.close()
+      return
+
+    def test_prepare(self):
+      from maildb import MailCorpus
+      msgs = list(MboxImporter(self.fname).finish())
+      self.assertEqual([ type(data) for (data, _, _) in msgs ], [str]*3)
+      r = []
+      for (data, _, _) in msgs:
+        (zdata, size, nattach, types, digest) = MailCorpus.prepare_message(data)
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO.StringIO(zdata)).read(), data)
+        r.append((size, nattach, types, digest != None))
+      self.assertEqual([ len(data) for (data, _, _) in msgs ], [ size for (size, _, _, _) in r ])
+      self.assertEqual([ x[1:] for x in r ],
+                       [(0, ['text/plain'], True),
+                        (1, ['image/png', 'text/html'], False),
+                        (0, ['text/plain'], False)])
+      return
+
+    def test_import(self):
+      from maildb import MailCorpus
+      # Imports the mbox into a new database and reads it back.
+      dirname = os.path.join(self.dirname, 'inbox')
+      os.mkdir(dirname)
+      MailCorpus.create(dirname)
+      corpus = MailCorpus(dirname)
+      corpus.open('r+')
+      merger = SpoolMerger([MboxImporter(self.fname)], cleanup=True)
+      locs = []
+      try:
+        for loc in ImportPipeline(corpus).run(merger):
+          locs.append(loc)
+          merger.commit()
+      finally:
+        merger.close()
+      self.assertEqual(locs, ['0', '1', '2'])
+      msgs = [ corpus.get_message(loc) for loc in locs ]
+      self.assertEqual(''.join(msgs), MBOX)
+      # The spool is removed after all the messages are committed.
+      self.assertFalse(os.path.exists(self.fname))
+      corpus.close()
+      return
+
+    def tearDown(self):
+      shutil.rmtree(self.dirname)
+      return
+
+  class MaildirImporterTest(unittest.TestCase):
+
+    def setUp(self):
+      self.dirname = tempfile.mkdtemp()
+      return
+
+    def test_spill(self):
+      # Filenames with tabs and newlines survive the spilled chunks.
+      names = ['a', 'b\tc', 'd\ne', 'f\\n']
+      for (i,name) in enumerate(names):
+        fp = file(os.path.join(self.dirname, name), 'wb')
+        fp.write('Date: Mon, %d Jan 2007 00:00:00 +0000\n\n%d\n' % (i+1, i))
+        fp.close()
+      imp = MaildirImporter(self.dirname, chunksize=1)
+      imp.read_messages()
+      self.assertEqual([ data for (data, _, _) in imp.finish() ],
+                       [ 'Date: Mon, %d Jan 2007 00:00:00 +0000\n\n%d\n' % (i+1, i)
+                         for i in xrange(len(names)) ])
+      imp.close(cleanup=True)
+      self.assertEqual(os.listdir(self.dirname), [])
+      return
+
+    def tearDown(self):
+      shutil.rmtree(self.dirname)
+      return
+
+  class RuleCacheTest(unittest.TestCase):
+
+    def setUp(self):
+      self.dirname = tempfile.mkdtemp()
+      self.fname = os.path.join(self.dirname, 'rules')
+      fp = file(self.fname, 'wb')
+      fp.write('rules')
+      fp.close()
+      return
+
+    def test_format(self):
+      cachename = os.path.join(self.dirname, 'rules.cache')
+      RuleCache(cachename).put(self.fname, 'rules', ['r'])
+      self.assertEqual(RuleCache(cachename).get(self.fname), ['r'])
+      # A cache of another format is not used.
+      cache = RuleCache(cachename)
+      cache.FORMAT = -1
+      self.assertEqual(cache.get(self.fname), None)
+      return
+
+    def tearDown(self):
+      shutil.rmtree(self.dirname)
+      return
+
+  unittest.main()
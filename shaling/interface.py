@@ -4,9 +4,95 @@ import config
 from utils import unique_name
 
 
+##  Character widths
+##
+##  The width of each character is looked up in a table made
+##  from unicodedata. The table has a string of 256 widths for
+##  each block of code points and is filled lazily.
+##  Wide characters take two columns and combining characters
+##  take none.
+##
+
+# Wide in the recent Unicode (emoji, CJK extensions).
+WIDE_RANGES = [
+  (0x1f300, 0x1f64f),
+  (0x1f680, 0x1f6ff),
+  (0x1f900, 0x1f9ff),
+  (0x20000, 0x3fffd),
+  ]
+
+_WIDTH_BLOCKS = {}
+def _make_width_block(b):
+  import unicodedata
+  ws = []
+  for i in xrange(b*256, b*256+256):
+    if 0xd800 <= i and i < 0xdc00:
+      # A high surrogate stands for a (likely wide) character.
+      w = 2
+    elif 0xdc00 <= i and i < 0xe000:
+      w = 0
+    elif i < 0xa0:
+      w = 1
+    else:
+      c = unichr(i)
+      if unicodedata.category(c) in ('Mn', 'Me', 'Cf') and i != 0xad:
+        w = 0
+      else:
+        w = { 'W': 2, 'F': 2, 'A': config.AMBIGUOUS_CHAR_WIDTH }.get(
+          unicodedata.east_asian_width(c), 1)
+        for (start,end) in WIDE_RANGES:
+          if start <= i and i <= end:
+            w = 2
+            break
+    ws.append(chr(w))
+  _WIDTH_BLOCKS[b] = block = ''.join(ws)
+  return block
+
 def charwidth(c):
-  if u'\u2000' <= c: return 2
-  return 1
+  i = ord(c)
+  block = _WIDTH_BLOCKS.get(i >> 8) or _make_width_block(i >> 8)
+  return ord(block[i & 255])
+
+# _WIDTH_MAP maps a code point to its width (as a character)
+# so that the widths of a string are taken by one translate().
+# The code points used as widths are seeded, as any unseen
+# character passes through translate() unchanged.
+_WIDTH_MAP = dict( (i, unichr(charwidth(unichr(i)))) for i in xrange(3) )
+_UNKNOWN_WIDTH = re.compile(u'[^\x00-\x02]')
+def _get_widths(us):
+  ws = us.translate(_WIDTH_MAP)
+  if _UNKNOWN_WIDTH.search(ws):
+    for c in set(us):
+      _WIDTH_MAP[ord(c)] = unichr(charwidth(c))
+    ws = us.translate(_WIDTH_MAP)
+  return ws
+
+# text_width: returns the number of columns of a string.
+def text_width(us):
+  try:
+    us.encode('ascii')
+    return len(us)
+  except UnicodeError:
+    pass
+  ws = _get_widths(us)
+  return len(ws) + ws.count(u'\x02') - ws.count(u'\x00')
+
+# truncate_to_width: returns (s, width) where s is the longest
+# prefix of a string that fits in n columns.
+def truncate_to_width(us, n):
+  try:
+    us.encode('ascii')
+    s = us[:max(0, n)]
+    return (s, len(s))
+  except UnicodeError:
+    pass
+  w = 0
+  for (i,c) in enumerate(_get_widths(us)):
+    w1 = ord(c)
+    if n < w+w1:
+      return (us[:i], w)
+    w += w1
+  return (us, w)
 
 
 ##  Interface
@@ -17,8 +103,11 @@ class Interface:
   class Cancelled(InterfaceError): pass
   class Unauthorized(InterfaceError): pass
   class Aborted(InterfaceError): pass
+  class PagerClosed(InterfaceError): pass
 
   UNPRINTABLE = re.compile('')
+  # Output is written in pieces of this size.
+  BUFSIZE = 32768
   
   def __init__(self, charset):
     import codecs
@@ -28,6 +117,8 @@ class Interface:
     self.lines = 0
     self.cols = 0
     self.title = ''
+    self.outbuf = []
+    self.outbufsize = 0
     return
 
   def set_title(self, title):
@@ -50,21 +141,45 @@ class Interface:
     return self.decoder(s, 'replace')[0]
 
   def length(self, us):
-    return sum( charwidth(c) for c in us )
+    return text_width(us)
+
+  def truncate(self, us, n):
+    return truncate_to_width(us, n)
 
   def warning(self, s):
     self.display(self.color(config.COLOR4WARNING, s)+'\n')
+    self.flush()
     return
 
   def notice(self, s):
     self.display(self.color(config.COLOR4INFO, s)+'\n')
+    self.flush()
     return
 
+  # display: buffers the output (an encoded string).
   def display(self, s):
+    assert isinstance(s, str)
+    self.outbuf.append(s)
+    self.outbufsize += len(s)
+    if self.BUFSIZE <= self.outbufsize:
+      self.flush_output()
+    return
+
+  # flush_output: writes the buffered output.
+  def flush_output(self):
+    if self.outbuf:
+      data = ''.join(self.outbuf)
+      self.outbuf = []
+      self.outbufsize = 0
+      self.write(data)
+    return
+
+  def write(self, data):
     raise NotImplementedError()
 
   def flush(self):
-    raise NotImplementedError()
+    self.flush_output()
+    return
 
   def show_binary(self, data, mimetype):
     raise NotImplementedError()
@@ -81,6 +196,10 @@ class Interface:
     raise Interface.InterfaceError('Unsupported on this terminal.')
 
   def save_file(self, data, filename, confirm=False):
+    return self.save_stream([data], filename, confirm)
+
+  # save_stream: saves data given in pieces.
+  def save_stream(self, chunks, filename, confirm=False):
     raise Interface.InterfaceError('Unsupported on this terminal.')
 
   def load_file(self, filename):
@@ -101,12 +220,12 @@ class DumbTerminalInterface(Interface):
     self.outfp = outfp
     return
   
-  def display(self, s):
-    assert isinstance(s, str)
-    self.outfp.write(s)
+  def write(self, data):
+    self.outfp.write(data)
     return
   
   def flush(self):
+    self.flush_output()
     self.outfp.flush()
     return
     
@@ -114,11 +233,17 @@ class DumbTerminalInterface(Interface):
     self.display(data)
     return
 
-  def save_file(self, data, filename, confirm=False):
+  def save_stream(self, chunks, filename, confirm=False):
     if not confirm and filename == '-':
-      self.outfp.write(data)
+      self.flush_output()
+      try:
+        for data in chunks:
+          self.outfp.write(data)
+      except ValueError, e:
+        raise Interface.Aborted(e)
     else:
       raise Interface.InterfaceError('Unsupported on this terminal.')
+    return
       
 
 ##  ColorTerminalInterface
@@ -179,6 +304,7 @@ class InteractiveTerminalInterface(ColorTerminalInterface):
     fp = tempfile.NamedTemporaryFile(prefix=unique_name('view'), dir=config.TMP_DIR)
     fp.write(data)
     fp.flush()
+    self.flush()
     cmdline = prog % fp.name
     status = os.WEXITSTATUS(os.system(cmdline))
     fp.close()
@@ -195,17 +321,28 @@ class InteractiveTerminalInterface(ColorTerminalInterface):
       raise Interface.Cancelled('Cancelled.')
     return s
 
-  def save_file(self, data, filename, confirm=False):
+  # save_stream: a decoding error (ValueError) in the middle of chunks
+  # does not leave a partial file.
+  def save_stream(self, chunks, filename, confirm=False):
     if confirm:
       filename = self.prompt('Filename [%s] ' % filename) or filename
     try:
       if filename == '-':
-        self.outfp.write(data)
+        self.flush_output()
+        for data in chunks:
+          self.outfp.write(data)
       else:
         fp = file(filename, 'wb')
-        fp.write(data)
-        fp.close()
-    except IOError, e:
+        try:
+          try:
+            for data in chunks:
+              fp.write(data)
+          finally:
+            fp.close()
+        except:
+          os.unlink(filename)
+          raise
+    except (IOError, ValueError), e:
       raise Interface.Aborted(e)
     return
       
@@ -228,6 +365,7 @@ class InteractiveTerminalInterface(ColorTerminalInterface):
     fp.write(self.to_terminal(data))
     fp.close()
     t0 = modtime(fname)
+    self.flush()
     cmdline = config.EDITOR % fp.name
     status = os.WEXITSTATUS(os.system(cmdline))
     if config.CHECK_EDITOR_STATUS and status:
@@ -241,24 +379,69 @@ class InteractiveTerminalInterface(ColorTerminalInterface):
     return
 
   def open_pager(self):
-    return PagerTerminalInterface(self.outfp, self.charset)
+    self.flush()
+    return PagerTerminalInterface(self.outfp, self.charset, self.lines)
 
 
 ##  PagerTerminalInterface
 ##
+##  The output is sent to the pager as it is produced. The first
+##  screen is flushed as soon as it is filled. Writing to a pager
+##  that has quit raises Interface.PagerClosed.
+##
 class PagerTerminalInterface(DumbTerminalInterface):
 
-  def __init__(self, outfp, charset):
+  def __init__(self, outfp, charset, lines=0):
     from subprocess import Popen, STDOUT, PIPE
     try:
       self.child = Popen(config.DEFAULT_PAGER, stdin=PIPE, stdout=None, stderr=STDOUT)
     except OSError, e:
       raise Interface.Aborted(e)
     DumbTerminalInterface.__init__(self, self.child.stdin, charset)
+    # Lines until the first screen is filled.
+    self.screen = lines or 24
+    self.closed = False
+    return
+
+  def display(self, s):
+    DumbTerminalInterface.display(self, s)
+    if self.screen:
+      self.screen -= s.count('\n')
+      if self.screen <= 0:
+        self.screen = 0
+        self.flush()
+    return
+
+  def write(self, data):
+    self.call(self.outfp.write, data)
+    return
+
+  def flush(self):
+    self.flush_output()
+    self.call(self.outfp.flush)
+    return
+
+  def call(self, func, *args):
+    # Once the pager has quit, the output is discarded.
+    import errno
+    if self.closed: return
+    try:
+      func(*args)
+    except IOError, e:
+      if e.errno != errno.EPIPE: raise
+      self.closed = True
+      raise Interface.PagerClosed('Pager closed.')
     return
   
   def wait_finish(self):
-    self.child.stdin.close()
+    try:
+      self.flush_output()
+    except Interface.PagerClosed:
+      pass
+    try:
+      self.child.stdin.close()
+    except IOError:
+      pass
     self.child.wait()
     return
   
@@ -4,14 +4,17 @@ try:
   import cPickle as pickle
 except ImportError:
   import pickle
-import config, message
+import config
 from getopt import getopt, GetoptError
 from utils import rmsp, unique_name, escape_unsafe_chars, \
      unicode_getalladdrs, unicode_getaddrs, \
      formataddr, msg_repr, get_msgids, \
-     get_message_part, validate_message_headers, \
+     get_message_part, scan_message_parts, extract_message_part, \
+     validate_message_headers, \
+     parse_date_spec, parse_size_spec, \
      MessagePartNotFoundError, MessageFormatError
-from maildb import MailCorpus, LabelPredicate, \
+from maildb import MailCorpus, LabelPredicate, MsgidPredicate, \
+     RecnoRangePredicate, MtimeFilter, \
      DEFAULT_FILTER, DEFAULT_FILTER_WITH_SENT
 from fooling.selection import EMailPredicate, YomiEMailPredicate, \
      Selection, DummySelection, SearchTimeout, canbe_yomi
@@ -67,6 +70,7 @@ class WindowMixin:
     return
 
   def list_messages(self, terminal, verbose=1):
+    import message
     if 0 < verbose:
       terminal.notice('Selection: %s' % self.description())
     n = 0
@@ -85,6 +89,10 @@ class WindowMixin:
         if n == self.window_size: break
       if 0 < verbose and n:
         (self.finished, self.nresults) = self.status()
+        if not self.finished:
+          nresults = self.fast_count()
+          if nresults != None:
+            (self.finished, self.nresults) = (1, nresults)
         results = '%d-%d of ' % (self.window_start+1, self.window_end+1)
         if not self.finished:
           results += 'about '
@@ -94,6 +102,20 @@ class WindowMixin:
       pass
     return n
   
+  def fast_count(self):
+    # Returns the exact number of messages if it can be
+    # obtained without running the search. Otherwise None.
+    return None
+
+  def count(self):
+    n = self.fast_count()
+    if n != None:
+      return n
+    for _ in self.iter(0):
+      pass
+    (self.finished, self.nresults) = self.status()
+    return self.nresults
+  
   RANGE_PAT1 = re.compile(r'(\d+):(\d+)')
   RANGE_PAT2 = re.compile(r'(\d+)-(\d+)')
   def get_messages(self, args, rel=0):
@@ -141,8 +163,15 @@ class MailSelection(Selection, WindowMixin):
     WindowMixin.__init__(self, window_size)
     Selection.__init__(self, corpus, term_preds, doc_preds,
                        safe=False, disjunctive=disjunctive)
+    self.disjunctive = disjunctive
     return
 
+  def fast_count(self):
+    # Label-only queries are counted from the label files.
+    preds = self.get_preds()
+    if self.disjunctive and 1 < len(preds): return None
+    return self.get_corpus().count_labeled(preds, self.doc_preds)
+
   def estimation(self):
     if self.finished:
       return '%d messages' % self.nresults
@@ -168,6 +197,9 @@ class DummyMailSelection(DummySelection, WindowMixin):
   def estimation(self):
     return '%d messages' % len(self.locs)
 
+  def fast_count(self):
+    return len(self.locs)
+
   def description(self):
     return self.descr
 
@@ -242,12 +274,34 @@ class Kernel:
       self.terminal.notice('Indexing %d docs...' % n)
     return
 
+  def notice_digesting(self, corpus):
+    n = corpus.get_undigested()
+    if config.VERBOSE_INDEX_THRESHOLD < n:
+      self.terminal.notice('Reading %d messages for duplicate detection...' % n)
+    return
+
+  def get_metadb(self, corpus):
+    n = corpus.get_unsummarized()
+    if config.VERBOSE_INDEX_THRESHOLD < n:
+      self.terminal.notice('Reading %d messages for their sizes and types...' % n)
+    return corpus.get_metadb()
+
   def close(self):
     self.save_current_selection()
     for corpus in self.corpus.itervalues():
       corpus.close(self.notice_indexing)
     return
 
+  # release: saves the selection and releases the write locks
+  # without closing the corpora (used by the kernel server).
+  def release(self):
+    self.save_current_selection()
+    for corpus in self.corpus.itervalues():
+      if corpus.mode == 'r+':
+        corpus.close(self.notice_indexing)
+        corpus.open()
+    return
+
   def get_corpus(self, dirname=config.INBOX_DIR):
     if dirname in self.corpus:
       corpus = self.corpus[dirname]
@@ -261,6 +315,16 @@ class Kernel:
   def get_messages(self, args, rel=0):
     return self.get_selection().get_messages(args, rel)
 
+  # get_part: returns (mpart, charset) of a part of doc.
+  # Only the part is parsed when the raw message can be scanned.
+  def get_part(self, doc, part):
+    data = doc.corpus.get_message(doc.loc)
+    index = scan_message_parts(data)
+    if index == None:
+      msg = doc.get_msg(0)
+      return (get_message_part(msg, part), msg.get_content_charset())
+    return (extract_message_part(data, index, part), index[0][4])
+
   # Show temporary selection.
   def select_tmp(self, descr, corpus, locs, verbose=0):
     locs = [ loc for loc in locs if 0 <= DEFAULT_FILTER(loc, corpus) ]
@@ -274,6 +338,7 @@ class Kernel:
   # but this might cause FileLockError.
   # In that case, the edit will be lost...
   def submit_message(self, data, original=None):
+    import message
     corpus = self.get_corpus()
     corpus.set_writable()
     if not original:
@@ -362,15 +427,103 @@ class Kernel:
     except ValueError:
       raise Kernel.ValueError('Invalid argument (integer expected): %r' % x)
 
+  # make_selection
+  def make_selection(self, corpus, args, nmsgs, search_all=False, disjunctive=False):
+    if args == ['all'] or args == ['a']:
+      # scan all the messages.
+      if search_all:
+        return MailSelection(corpus, [], window_size=nmsgs)
+      return MailSelection(corpus, [], doc_preds=[ DEFAULT_FILTER ],
+                           window_size=nmsgs)
+    # scan "something"
+    terms = []
+    label_preds = []
+    doc_preds = [ DEFAULT_FILTER ]
+    dates = []
+    (t0, t1) = (None, None)
+    for kw in args:
+      if not kw: continue
+      if kw.startswith('since:') or kw.startswith('until:'):
+        try:
+          if kw.startswith('since:'):
+            t0 = parse_date_spec(kw[6:])
+          else:
+            t1 = parse_date_spec(kw[6:], end=True)
+        except ValueError, e:
+          raise Kernel.ValueError(str(e))
+        dates.append(kw)
+        continue
+      if kw.startswith('size:'):
+        try:
+          (smin, smax) = parse_size_spec(kw[5:])
+        except ValueError, e:
+          raise Kernel.ValueError(str(e))
+        msgids = self.get_metadb(corpus).find_size(smin, smax)
+        label_preds.append(MsgidPredicate(kw, msgids))
+        continue
+      if kw.startswith('has:'):
+        t = kw[4:].lower()
+        if t == 'attachment':
+          msgids = self.get_metadb(corpus).find_attached()
+        else:
+          msgids = self.get_metadb(corpus).find_type(t)
+        label_preds.append(MsgidPredicate(kw, msgids))
+        continue
+      if kw[0] != '+':
+        terms.append(kw)
+        continue
+      kw = kw[1:]
+      if not kw:
+        raise Kernel.SyntaxError('Invalid label spec.')
+      try:
+        if kw[0] in '!-':
+          pred = LabelPredicate(corpus.get_labeldb(), kw[1:], True)
+        else:
+          pred = LabelPredicate(corpus.get_labeldb(), kw, False)
+          if config.str2label(kw) in config.FILTERED_LABELS:
+            doc_preds = []
+      except config.UnknownLabel, e:
+        raise Kernel.ValueError('Unknown label: %s' % e)
+      label_preds.append(pred)
+    if dates:
+      # Only the messages in the matching recno ranges are searched.
+      label_preds.append(RecnoRangePredicate(' '.join(dates),
+                                             corpus.get_mtime_ranges(t0, t1)))
+    term_preds = [ EMailPredicate(kw) for kw in terms ]
+    # Automatic query expansion.
+    def forall(pred, seq):
+      for x in seq:
+        if not pred(x): return False
+      return True
+    if len(terms) == 1 and terms[0].isalpha() and canbe_yomi(terms[0]) and not label_preds:
+      term_preds = [ YomiEMailPredicate(terms[0]),
+                     EMailPredicate(terms[0]) ]
+      disjunctive = True
+    elif forall(canbe_yomi, terms):
+      term_preds = [ YomiEMailPredicate(kw) for kw in terms ]
+    else:
+      def stripdot(x):
+        if x.startswith('.'):
+          return x[1:]
+        return x
+      term_preds = [ EMailPredicate(stripdot(kw)) for kw in terms ]
+    if search_all:
+      doc_preds = []
+    if dates:
+      doc_preds.append(MtimeFilter(t0, t1))
+    return MailSelection(corpus, term_preds+label_preds, doc_preds,
+                         disjunctive=disjunctive, window_size=nmsgs)
+
   # cmd_scan
   def cmd_scan(self, args):
-    'usage: scan [-q] [-n nmsgs] [-S selection] [-a)ll] [-P)rev|-N)ext|-R)eset] [-O)r] predicates ...'
+    'usage: scan [-q] [-c)ount] [-n nmsgs] [-S selection] [-a)ll] [-P)rev|-N)ext|-R)eset] [-O)r] predicates ...'
     try:
-      (opts, args) = getopt(args, 'qn:S:aPNRO')
+      (opts, args) = getopt(args, 'qcn:S:aPNRO')
     except GetoptError:
       raise Kernel.ShowUsage()
     # Get command line options.
     verbose = 1
+    count = False
     nmsgs = config.SCAN_DEFAULT_MSGS
     selection = 0
     disjunctive = False
@@ -378,6 +531,7 @@ class Kernel:
     rel = 0
     for (k,v) in opts:
       if k == '-q': verbose -= 1
+      elif k == '-c': count = True
       elif k == '-n': nmsgs = Kernel.safeint(v)
       elif k == '-S': selection = Kernel.safeint(v)
       elif k == '-a':
@@ -393,65 +547,16 @@ class Kernel:
       # (argument omitted and the previous selection is saved.)
       selection = self.get_selection(selection)
       selection.slide_window(rel, nmsgs)
-      corpus = selection.get_corpus()
     else:
-      corpus = self.get_corpus()
       # Query specified.
       # Create an appropriate selection.
-      if args == ['all'] or args == ['a']:
-        # scan all the messages.
-        if search_all:
-          selection = MailSelection(corpus, [], window_size=nmsgs)
-        else:
-          selection = MailSelection(corpus, [],
-                                    doc_preds=[ DEFAULT_FILTER ],
-                                    window_size=nmsgs)
-      else:
-        # scan "something"
-        terms = []
-        label_preds = []
-        doc_preds = [ DEFAULT_FILTER ]
-        for kw in args:
-          if not kw: continue
-          if kw[0] != '+':
-            terms.append(kw)
-            continue
-          kw = kw[1:]
-          if not kw:
-            raise Kernel.SyntaxError('Invalid label spec.')
-          try:
-            if kw[0] in '!-':
-              pred = LabelPredicate(corpus.get_labeldb(), kw[1:], True)
-            else:
-              pred = LabelPredicate(corpus.get_labeldb(), kw, False)
-              if config.str2label(kw) in config.FILTERED_LABELS:
-                doc_preds = []
-          except config.UnknownLabel, e:
-            raise Kernel.ValueError('Unknown label: %s' % e)
-          label_preds.append(pred)
-        term_preds = [ EMailPredicate(kw) for kw in terms ]
-        # Automatic query expansion.
-        def forall(pred, seq):
-          for x in seq:
-            if not pred(x): return False
-          return True
-        if len(terms) == 1 and terms[0].isalpha() and canbe_yomi(terms[0]) and not label_preds:
-          term_preds = [ YomiEMailPredicate(terms[0]),
-                         EMailPredicate(terms[0]) ]
-          disjunctive = True
-        elif forall(canbe_yomi, terms):
-          term_preds = [ YomiEMailPredicate(kw) for kw in terms ]
-        else:
-          def stripdot(x):
-            if x.startswith('.'):
-              return x[1:]
-            return x
-          term_preds = [ EMailPredicate(stripdot(kw)) for kw in terms ]
-        if search_all:
-          doc_preds = []
-        selection = MailSelection(corpus, term_preds+label_preds, doc_preds,
-                                  disjunctive=disjunctive, window_size=nmsgs)
+      selection = self.make_selection(self.get_corpus(), args, nmsgs,
+                                      search_all, disjunctive)
 
+    if count:
+      # Only count the results.
+      self.terminal.display('%d\n' % selection.count())
+      return
     # Perform search.
     n = selection.list_messages(self.terminal, verbose)
     if not n: raise Kernel.ValueError('Not found.')
@@ -459,9 +564,36 @@ class Kernel:
     self.set_selection(selection)
     return
 
+  # cmd_count
+  def cmd_count(self, args):
+    'usage: count [-S selection] [-a)ll] [-O)r] predicates ...'
+    try:
+      (opts, args) = getopt(args, 'S:aO')
+    except GetoptError:
+      raise Kernel.ShowUsage()
+    #
+    selection = 0
+    disjunctive = False
+    search_all = False
+    for (k,v) in opts:
+      if k == '-S': selection = Kernel.safeint(v)
+      elif k == '-a':
+        search_all = True
+        if not args: args = ['all']
+      elif k == '-O': disjunctive = True
+    #
+    if not args:
+      selection = self.get_selection(selection)
+    else:
+      selection = self.make_selection(self.get_corpus(), args, 0,
+                                      search_all, disjunctive)
+    self.terminal.display('%d\n' % selection.count())
+    return
+
   # cmd_show
   def cmd_show(self, args):
     'usage: show [-q] [-l)ist] [-a)ll] [-h)eaders] [-c charset] [-P)rev|-N)ext] msg:part ...'
+    import message
     try:
       (opts, args) = getopt(args, 'qlahc:PN')
     except GetoptError:
@@ -495,8 +627,9 @@ class Kernel:
                              showall, showall, headerlevel, verbose)
         continue
       try:
-        message.show_mime_part(self.terminal, doc.get_msg(0),
-                               part, headerlevel, charset)
+        (mpart, charset1) = self.get_part(doc, part)
+        message.show_mime_part(self.terminal, mpart,
+                               headerlevel, charset1 or charset)
       except MessagePartNotFoundError:
         raise Kernel.ValueError('Message part not found.')
     return
@@ -504,6 +637,7 @@ class Kernel:
   # cmd_get
   def cmd_get(self, args):
     'usage: get [-f|-F field] [-o filename] msg:part'
+    import message
     try:
       (opts, args) = getopt(args, 'f:F:c:o:')
     except GetoptError:
@@ -529,20 +663,26 @@ class Kernel:
     confirm = False
     if part == None:
       # Save the entire message.
-      data = doc.corpus.get_message(doc.loc)
+      chunks = doc.corpus.iter_message(doc.loc)
     else:
-      # Save the mime part.
+      # Save the mime part, decoding it while decompressing.
+      import mimestream
       try:
-        mpart = get_message_part(doc.get_msg(0), part)
-      except MessagePartNotFoundError:
+        try:
+          (headers, chunks) = mimestream.open_part(doc.corpus.iter_message(doc.loc), part)
+        except mimestream.Unsupported:
+          (headers, _) = self.get_part(doc, part)
+          chunks = [ headers.get_payload(decode=True) ]
+      except (MessagePartNotFoundError, mimestream.PartNotFound):
         raise Kernel.ValueError('Message part not found.')
+      except mimestream.DecodeError, e:
+        raise Kernel.ValueError('Cannot decode the part: %s' % e)
       if not outputfile:
-        outputfile = escape_unsafe_chars(mpart.get_filename() or '')
+        outputfile = escape_unsafe_chars(headers.get_filename() or '')
         confirm = True
-      data = mpart.get_payload(decode=True)
     if not outputfile:
       raise Kernel.ValueError('Speficy the filename to save.')
-    self.terminal.save_file(data, outputfile, confirm)
+    self.terminal.save_stream(chunks, outputfile, confirm)
     return
 
   # cmd_resolve
@@ -574,6 +714,7 @@ class Kernel:
   # cmd_comp
   def cmd_comp(self, args):
     'usage: comp [-g)roup] [-r)eply] [-F)orward] [-s subject] [+label] [msg:part] addrs ...'
+    import message
     try:
       (opts, args) = getopt(args, 'grFs:')
     except GetoptError:
@@ -659,6 +800,7 @@ class Kernel:
   # cmd_edit
   def cmd_edit(self, args):
     'usage: edit [-f)orce] [msg]'
+    import message
     try:
       (opts, args) = getopt(args, 'f')
     except GetoptError:
@@ -682,6 +824,7 @@ class Kernel:
   # cmd_mime
   def cmd_mime(self, args):
     'usage: mime [-R)emove] [-m mimetype] [-c charset] msg[:part] files ...'
+    import message
     try:
       (opts, args) = getopt(args, 'Rm:c:')
     except GetoptError:
@@ -786,17 +929,20 @@ class Kernel:
 
   # cmd_send
   def cmd_send(self, args):
-    'usage: send [-q)uiet] [-f)orce] [msg] ...'
+    'usage: send [-q)uiet] [-f)orce] [-s)ynchronous] [msg] ...'
+    import message
     try:
-      (opts, args) = getopt(args, 'qf')
+      (opts, args) = getopt(args, 'qfs')
     except GetoptError:
       raise Kernel.ShowUsage()
     #
     force = False
     verbose = 1
+    synchronous = config.SEND_SYNCHRONOUSLY
     for (k,v) in opts:
       if k == '-q': verbose = 0
       elif k == '-f': force = True
+      elif k == '-s': synchronous = True
     #
     (docs, args) = self.get_messages(args or ['.'])
     if args:
@@ -817,20 +963,69 @@ class Kernel:
     # Move the message from the draft to inbox (sent).
     corpus = self.get_selection().get_corpus()
     corpus.set_writable()
-    for (loc,msg,fromaddr,rcpts) in msgs:
-      try:
-        data = message.send_message(msg, fromaddr, rcpts)
-      except message.MessageTransportError, e:
-        raise Kernel.ValueError('%s: %r' % (e, rcpts))
-      if verbose:
-        self.terminal.notice('From: %r' % fromaddr)
-        self.terminal.notice('Rcpt: %r' % rcpts)
-      corpus.mark_deleted(loc)
-      corpus.add_message(data, config.LABEL4SENT)
+    if not synchronous:
+      # Queue the messages and deliver them in the background.
+      import outbox
+      box = outbox.Outbox(config.OUTBOX_DIR)
+      for (loc,msg,fromaddr,rcpts) in msgs:
+        data = message.finalize_message(msg)
+        box.put(fromaddr, rcpts, data)
+        if verbose:
+          self.terminal.notice('From: %r' % fromaddr)
+          self.terminal.notice('Rcpt: %r (queued)' % rcpts)
+        corpus.mark_deleted(loc)
+        corpus.add_message(data, config.LABEL4SENT)
+      corpus.flush(self.notice_indexing)
+      self.remove_selection()
+      outbox.start_worker()
+      return
+    # All the messages are sent through one connection.
+    session = message.SMTPSession()
+    try:
+      for (loc,msg,fromaddr,rcpts) in msgs:
+        try:
+          data = message.send_message(msg, fromaddr, rcpts, session)
+        except message.MessageTransportError, e:
+          raise Kernel.ValueError('%s: %r' % (e, rcpts))
+        if verbose:
+          self.terminal.notice('From: %r' % fromaddr)
+          self.terminal.notice('Rcpt: %r' % rcpts)
+        corpus.mark_deleted(loc)
+        corpus.add_message(data, config.LABEL4SENT)
+    finally:
+      session.close()
     corpus.flush(self.notice_indexing)
     self.remove_selection()
     return
 
+  # cmd_outbox
+  def cmd_outbox(self, args):
+    'usage: outbox [-d)eliver] [-r)etry]'
+    import outbox, time
+    try:
+      (opts, args) = getopt(args, 'dr')
+    except GetoptError:
+      raise Kernel.ShowUsage()
+    #
+    box = outbox.Outbox(config.OUTBOX_DIR)
+    for (k,v) in opts:
+      if k == '-r':
+        self.terminal.notice('%d message(s) requeued.' % box.retry_failed())
+      elif k == '-d':
+        try:
+          (nsent, nfailed) = box.deliver()
+        except outbox.Outbox.Busy, e:
+          raise Kernel.ValueError(str(e))
+        self.terminal.notice('%d sent, %d failed.' % (nsent, nfailed))
+    for (failed, t, fromaddr, rcpts, attempts, error) in box.list_messages():
+      if failed:
+        status = 'failed'
+      else:
+        status = 'next: %s' % time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(t))
+      self.terminal.notice('%s -> %s (%s, %d attempt(s)) %s' %
+                           (fromaddr, ', '.join(rcpts), status, attempts, error or ''))
+    return
+
   # cmd_inc
   def cmd_inc(self, args):
     'usage: inc [-q)uiet] [-E)rase] [-P)reserve] [-r rulefile] [+label] [spool ...]'
@@ -860,25 +1055,38 @@ class Kernel:
       raise Kernel.ValueError('Invalid ruleset: %s' % e)
     corpus = self.get_corpus()
     corpus.set_writable()
+    if config.DUPLICATE_ACTION:
+      self.notice_digesting(corpus)
+    pipeline = importer.ImportPipeline(corpus, dup_action=config.DUPLICATE_ACTION)
+    try:
+      importers = importer.CreateMessageImporters([ spool for spool in spools if spool ], ruleset)
+    except importer.MessagePOP3Error, e:
+      raise Kernel.ValueError(str(e))
+    merger = importer.SpoolMerger(importers, cleanup)
     locs = []
-    for spool in spools:
-      if not spool: continue
-      importer = importer.CreateMessageImporter(spool, ruleset)
-      importer.read_messages()
-      if importer.is_empty(): continue
-      for (data,labels,mtime) in importer.finish():
-        locs.append(corpus.add_message(data, labels, mtime))
-      importer.close(cleanup)
+    error = None
+    try:
+      for loc in pipeline.run(merger):
+        if loc != None:
+          locs.append(loc)
+        merger.commit()
+    except importer.MessagePOP3Error, e:
+      # The messages imported so far are kept.
+      error = e
+    finally:
+      merger.close()
     corpus.flush(self.notice_indexing)
     if verbose and locs:
       locs.reverse()
       self.select_tmp('inc', corpus, locs)
+    if error:
+      raise Kernel.ValueError('POP3 error: %s' % error)
     return
 
   # cmd_apply
   def cmd_apply(self, args):
     'usage: apply [-r rulefile] [-n)ull] [-v)erbose] [-R)eset] [msg]'
-    import importer
+    import importer, message
     try:
       (opts, args) = getopt(args, 'nvRr:')
     except GetoptError:
@@ -948,6 +1156,34 @@ class Kernel:
                               selection.estimation()))
     return
   
+  # cmd_dedup
+  def cmd_dedup(self, args):
+    'usage: dedup [-l)abel] [-q)uiet]'
+    try:
+      (opts, args) = getopt(args, 'lq')
+    except GetoptError:
+      raise Kernel.ShowUsage()
+    #
+    label = False
+    verbose = 1
+    for (k,v) in opts:
+      if k == '-l': label = True
+      elif k == '-q': verbose = 0
+    #
+    corpus = self.get_corpus()
+    if label:
+      corpus.set_writable()
+    self.notice_digesting(corpus)
+    locs = [ loc for (loc,_) in corpus.find_duplicates() ]
+    if label:
+      for loc in locs:
+        corpus.add_message_label(loc, config.LABEL4DUPLICATE)
+    self.terminal.notice('%d duplicate(s) found.' % len(locs))
+    if verbose and locs and not label:
+      locs.reverse()
+      self.select_tmp('dedup', corpus, locs)
+    return
+
   # cmd_cleanup
   def cmd_cleanup(self, args):
     'usage: cleanup'
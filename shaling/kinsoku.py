@@ -12,3 +12,54 @@ WORD_PAT = re.compile(r'''
         \S |                            # other chars
         \s+                             # space
         ''', re.VERBOSE | re.UNICODE)
+
+
+##  TextFolder
+##
+##  Folds text into lines of the given width at word boundaries.
+##  Lines are made lazily and the widths of words are cached.
+##
+class TextFolder:
+
+  MAX_CACHE = 10000
+
+  def __init__(self, width, length):
+    self.width = width
+    self.length = length
+    self._widths = {}
+    return
+
+  def __repr__(self):
+    return '<TextFolder: width=%d>' % self.width
+
+  def fold_line(self, line, indent2=''):
+    width = self.width
+    # Each character takes two columns at most.
+    if len(line) <= width/2:
+      yield line
+      return
+    widths = self._widths
+    if self.MAX_CACHE < len(widths):
+      widths.clear()
+    s = []
+    l0 = 0
+    for m in WORD_PAT.finditer(line):
+      w = m.group(0)
+      try:
+        l1 = widths[w]
+      except KeyError:
+        l1 = widths[w] = self.length(w)
+      if s and (width < l0+l1):
+        yield ''.join(s)
+        s = [indent2]
+        l0 = len(indent2)
+      s.append(w)
+      l0 += l1
+    yield ''.join(s)
+    return
+
+  def fold(self, text, indent2=''):
+    for line in text.splitlines():
+      for s in self.fold_line(line, indent2):
+        yield s
+    return
@@ -34,19 +34,16 @@ class EMailDocumentWithLabel(EMailDocument):
     return self.corpus.get_message_labels(self.loc)
 
 
-##  LabelPredicate
+##  MsgidPredicate
+##  matches a precomputed set of msgids.
 ##
-class LabelPredicate(Predicate):
-  
-  def __init__(self, labeldb, name, neg):
+class MsgidPredicate(Predicate):
+
+  def __init__(self, q, msgids, neg=False):
     Predicate.__init__(self)
     self.neg = neg
-    label = config.str2label(name)
-    if neg:
-      self.q = '+!'+name
-    else:
-      self.q = '+'+name
-    self.msgids = sorted(labeldb.get_msgids(label), reverse=True)
+    self.q = q
+    self.msgids = sorted(msgids, reverse=True)
     self.curidx = 0
     return
 
@@ -74,12 +71,60 @@ class LabelPredicate(Predicate):
     return locs
 
 
+##  LabelPredicate
+##
+class LabelPredicate(MsgidPredicate):
+  
+  def __init__(self, labeldb, name, neg):
+    label = config.str2label(name)
+    self.label = label
+    if neg:
+      q = '+!'+name
+    else:
+      q = '+'+name
+    MsgidPredicate.__init__(self, q, labeldb.get_msgids(label), neg)
+    return
+
+
+##  RecnoRangePredicate
+##
+class RecnoRangePredicate(Predicate):
+
+  def __init__(self, q, ranges):
+    Predicate.__init__(self)
+    self.q = q
+    # ranges: [(start, end), ...] in descending order.
+    self.ranges = ranges
+    return
+
+  def __str__(self):
+    return self.q
+
+  def narrow(self, idx):
+    # Assuming: each index covers a contiguous range of msgids.
+    (docids,_) = struct.unpack('>ii', idx[''])
+    try:
+      lastmsgid = int(idx['\x00'+struct.pack('>i', docids-1)])
+    except (KeyError, ValueError):
+      return []
+    locs = []
+    for (start,end) in self.ranges:
+      for msgid in xrange(min(end-1, lastmsgid), start-1, -1):
+        k = '\xff'+str(msgid)
+        # The rest is in older indices.
+        if not idx.has_key(k): return locs
+        (docid,) = struct.unpack('>i', idx[k])
+        locs.append((docid, 0))
+    return locs
+
+
 ##  LabelBlock / LabelPass
 ##  picklable function objects for doc_preds.
 ##
 class LabelBlock:
 
   def __init__(self, labels):
+    self.labels = ''.join(sorted(labels))
     self.filter_pat = re.compile(r'[%s]' % re.escape(''.join(labels)))
     return
 
@@ -90,6 +135,7 @@ class LabelBlock:
 class LabelPass:
   
   def __init__(self, labels):
+    self.labels = ''.join(sorted(labels))
     pat = ''
     for c in sorted(labels):
       c = re.escape(c)
@@ -106,6 +152,22 @@ class LabelPass:
 class DefaultLabelBlock(LabelBlock):
   def __str__(self):
     return ''
+class MtimeFilter:
+
+  def __init__(self, t0, t1):
+    self.t0 = t0
+    self.t1 = t1
+    return
+
+  def __str__(self):
+    return ''
+
+  def __call__(self, loc, corpus):
+    t = corpus.loc_mtime(loc)
+    if self.t0 != None and t < self.t0: return -1
+    if self.t1 != None and self.t1 <= t: return -1
+    return 0
+
 DEFAULT_FILTER = DefaultLabelBlock(config.FILTERED_LABELS)
 DEFAULT_FILTER_WITH_SENT = DefaultLabelBlock(config.FILTERED_LABELS.difference([config.LABEL4SENT]))
 
@@ -150,6 +212,16 @@ class LabelDB:
     self.cache[label] = msgids
     return msgids
 
+  def list_labels(self):
+    labels = set(self.cache.iterkeys())
+    for fname in os.listdir(self.basedir):
+      if fname.startswith(self.prefix+'_'):
+        try:
+          labels.add(chr(int(fname[len(self.prefix)+1:], 16)))
+        except ValueError:
+          pass
+    return sorted(labels)
+
   def add_label(self, msgid, labels):
     '''
     labels: a sequence or set of characters that represent labels.
@@ -186,6 +258,352 @@ class LabelDB:
     return
 
 
+##  MtimeIndex
+##
+##  Keeps the minimum and maximum mtime of every block of records
+##  so that a date range can be turned into recno ranges without
+##  reading each tar header.
+##
+class MtimeIndex:
+
+  class MtimeIndexError(Exception): pass
+  class FileError(MtimeIndexError): pass
+
+  BLOCK_SIZE = 64
+
+  def __init__(self, fname, block_size=BLOCK_SIZE):
+    self.fname = fname
+    self.block_size = block_size
+    self.nrecords = None
+    self.blocks = None
+    self.changed = False
+    return
+
+  def __repr__(self):
+    return '<MtimeIndex: fname=%r, nrecords=%r, changed=%r>' % \
+           (self.fname, self.nrecords, self.changed)
+
+  def load(self):
+    if self.blocks != None: return
+    self.nrecords = 0
+    self.blocks = []
+    if os.path.exists(self.fname):
+      try:
+        fp = file(self.fname, 'rb')
+        data = fp.read()
+        fp.close()
+      except IOError, e:
+        raise MtimeIndex.FileError(e)
+      (self.nrecords,) = struct.unpack('>i', data[:4])
+      v = struct.unpack('>%di' % ((len(data)-4)/4), data[4:])
+      self.blocks = [ [v[i], v[i+1]] for i in xrange(0, len(v), 2) ]
+    return
+
+  def add(self, recno, mtime):
+    self.load()
+    # Records that are not contiguous are filled by update().
+    if recno != self.nrecords: return
+    i = recno / self.block_size
+    if i < len(self.blocks):
+      block = self.blocks[i]
+      block[0] = min(block[0], mtime)
+      block[1] = max(block[1], mtime)
+    else:
+      self.blocks.append([mtime, mtime])
+    self.nrecords += 1
+    self.changed = True
+    return
+
+  def update(self, db):
+    self.load()
+    if len(db) < self.nrecords:
+      # The database has been rebuilt.
+      self.nrecords = 0
+      self.blocks = []
+    for recno in xrange(self.nrecords, len(db)):
+      self.add(recno, db.get_info(recno).mtime)
+    return
+
+  def get_ranges(self, t0, t1):
+    '''
+    Returns recno ranges [(start, end), ...] in descending order
+    that contain every message whose mtime is t0 <= mtime < t1.
+    '''
+    self.load()
+    ranges = []
+    for (i,(tmin,tmax)) in enumerate(self.blocks):
+      if t0 != None and tmax < t0: continue
+      if t1 != None and t1 <= tmin: continue
+      start = i*self.block_size
+      end = min(start+self.block_size, self.nrecords)
+      if ranges and ranges[-1][1] == start:
+        ranges[-1] = (ranges[-1][0], end)
+      else:
+        ranges.append((start, end))
+    ranges.reverse()
+    return ranges
+
+  def close(self):
+    if self.changed:
+      v = []
+      for block in self.blocks:
+        v.extend(block)
+      data = struct.pack('>i%di' % len(v), self.nrecords, *v)
+      try:
+        fp = file(self.fname, 'wb')
+        fp.write(data)
+        fp.close()
+      except IOError:
+        pass
+      self.changed = False
+    return
+
+
+##  MetaDB
+##
+##  Columnar metadata of messages: the uncompressed size, the number
+##  of attachments and the MIME types (as a bitmask over the type
+##  names) of each record.
+##
+class MetaDB:
+
+  class MetaDBError(Exception): pass
+  class FileError(MetaDBError): pass
+
+  COLUMNS = ('size', 'nattach', 'types')
+  MAX_TYPES = 32
+  OTHER_TYPE = '*/*'
+
+  def __init__(self, basedir, prefix='meta'):
+    if not os.path.isdir(basedir):
+      raise MetaDB.FileError('%r is not a directory.' % basedir)
+    self.basedir = basedir
+    self.prefix = prefix
+    self.columns = None
+    self.typenames = None
+    self.changed = False
+    return
+
+  def __repr__(self):
+    return '<MetaDB: basedir=%r, prefix=%r, nrecords=%r, changed=%r>' % \
+           (self.basedir, self.prefix, self.columns and len(self), self.changed)
+
+  def __len__(self):
+    self.load()
+    return min( len(column) for column in self.columns.itervalues() )
+
+  def get_file(self, name):
+    return os.path.join(self.basedir, '%s_%s' % (self.prefix, name))
+
+  def load(self):
+    if self.columns != None: return
+    self.columns = {}
+    try:
+      for name in self.COLUMNS:
+        fname = self.get_file(name)
+        if os.path.exists(fname):
+          fp = file(fname, 'rb')
+          data = fp.read()
+          fp.close()
+          self.columns[name] = list(struct.unpack('>%dI' % (len(data)/4), data))
+        else:
+          self.columns[name] = []
+      fname = self.get_file('typenames')
+      if os.path.exists(fname):
+        fp = file(fname, 'rb')
+        self.typenames = fp.read().split()
+        fp.close()
+      else:
+        self.typenames = []
+    except IOError, e:
+      raise MetaDB.FileError(e)
+    return
+
+  def get_typemask(self, types):
+    mask = 0
+    for t in types:
+      if t not in self.typenames:
+        if len(self.typenames) < self.MAX_TYPES-1:
+          self.typenames.append(t)
+        else:
+          t = self.OTHER_TYPE
+          if t not in self.typenames:
+            self.typenames.append(t)
+      mask |= 1 << self.typenames.index(t)
+    return mask
+
+  def add(self, recno, size, nattach, types):
+    # Records that are not contiguous are filled by update().
+    if recno != len(self): return
+    self.columns['size'].append(size)
+    self.columns['nattach'].append(nattach)
+    self.columns['types'].append(self.get_typemask(types))
+    self.changed = True
+    return
+
+  def update(self, corpus):
+    from utils import get_mime_summary
+    n = len(self)
+    if len(corpus) < n:
+      # The database has been rebuilt.
+      n = 0
+    for column in self.columns.itervalues():
+      if n < len(column):
+        del column[n:]
+        self.changed = True
+    for recno in xrange(n, len(corpus)):
+      data = corpus.get_message(recno)
+      (types, nattach) = get_mime_summary(data)
+      self.add(recno, len(data), nattach, types)
+    return
+
+  def get_size(self, recno):
+    return self.columns['size'][recno]
+
+  def total_size(self):
+    return sum(self.columns['size'])
+
+  def find_size(self, smin=None, smax=None):
+    return [ recno for (recno,size) in enumerate(self.columns['size'])
+             if (smin == None or smin < size) and (smax == None or size < smax) ]
+
+  def find_attached(self):
+    return [ recno for (recno,n) in enumerate(self.columns['nattach']) if n ]
+
+  def find_type(self, t):
+    # t is either a full type (image/png) or a main type (image).
+    mask = 0
+    for (i,name) in enumerate(self.typenames):
+      if name == t or name.startswith(t+'/'):
+        mask |= 1 << i
+    if not mask: return []
+    return [ recno for (recno,m) in enumerate(self.columns['types']) if m & mask ]
+
+  def close(self):
+    if self.changed:
+      try:
+        for name in self.COLUMNS:
+          column = self.columns[name]
+          fp = file(self.get_file(name), 'wb')
+          fp.write(struct.pack('>%dI' % len(column), *column))
+          fp.close()
+        fp = file(self.get_file('typenames'), 'wb')
+        fp.write(''.join( t+'\n' for t in self.typenames ))
+        fp.close()
+      except IOError:
+        pass
+      self.changed = False
+    return
+
+
+##  DigestIndex
+##
+##  A digest (of the Message-ID and the body) of each record,
+##  stored as fixed-size records and used for detecting duplicates.
+##  A record without a digest is stored as NODIGEST.
+##
+class DigestIndex:
+
+  class DigestIndexError(Exception): pass
+  class FileError(DigestIndexError): pass
+
+  RECSIZE = 16
+  NODIGEST = '\x00'*RECSIZE
+
+  def __init__(self, fname):
+    self.fname = fname
+    self.digests = None
+    self.table = None
+    self.nsaved = 0
+    return
+
+  def __repr__(self):
+    return '<DigestIndex: fname=%r, nrecords=%r, nsaved=%r>' % \
+           (self.fname, self.digests and len(self.digests), self.nsaved)
+
+  def __len__(self):
+    self.load()
+    return len(self.digests)
+
+  def load(self):
+    if self.digests != None: return
+    self.digests = []
+    self.table = {}
+    if os.path.exists(self.fname):
+      try:
+        fp = file(self.fname, 'rb')
+        data = fp.read()
+        fp.close()
+      except IOError, e:
+        raise DigestIndex.FileError(e)
+      n = self.RECSIZE
+      for i in xrange(0, len(data)-n+1, n):
+        self.add(i/n, data[i:i+n])
+    self.nsaved = len(self.digests)
+    return
+
+  def add(self, recno, digest):
+    self.load()
+    # Records that are not contiguous are filled by update().
+    if recno != len(self.digests): return
+    if digest == None:
+      digest = self.NODIGEST
+    self.digests.append(digest)
+    if digest != self.NODIGEST:
+      self.table.setdefault(digest, []).append(recno)
+    return
+
+  def get_missing(self, corpus):
+    # Returns the number of records to be digested by update().
+    self.load()
+    if len(corpus) < len(self.digests):
+      return len(corpus)
+    return len(corpus)-len(self.digests)
+
+  def update(self, corpus):
+    from utils import get_message_digest
+    self.load()
+    if len(corpus) < len(self.digests):
+      # The database has been rebuilt.
+      self.digests = []
+      self.table = {}
+      self.nsaved = -1
+    for recno in xrange(len(self.digests), len(corpus)):
+      self.add(recno, get_message_digest(corpus.get_message(recno)))
+    return
+
+  def lookup(self, digest):
+    # Returns the records that have the digest.
+    self.load()
+    return self.table.get(digest, [])
+
+  def find_groups(self):
+    '''
+    Yields the list of records for every digest that is shared
+    by more than one record.
+    '''
+    self.load()
+    for recnos in self.table.itervalues():
+      if 2 <= len(recnos):
+        yield recnos
+    return
+
+  def close(self):
+    if self.digests != None and self.nsaved != len(self.digests):
+      try:
+        if self.nsaved < 0:
+          fp = file(self.fname, 'wb')
+          fp.write(''.join(self.digests))
+        else:
+          fp = file(self.fname, 'ab')
+          fp.write(''.join(self.digests[self.nsaved:]))
+        fp.close()
+        self.nsaved = len(self.digests)
+      except IOError:
+        pass
+    return
+
+
 ##  MailCorpus
 ##
 class MailCorpus(Corpus):
@@ -211,6 +629,9 @@ class MailCorpus(Corpus):
     del odict['mode']
     del odict['_db']
     del odict['_labeldb']
+    del odict['_mtimeidx']
+    del odict['_metadb']
+    del odict['_digestidx']
     del odict['_last_unindexed_loc']
     return odict
 
@@ -221,6 +642,9 @@ class MailCorpus(Corpus):
     self._last_unindexed_loc = None
     self._db = TarDB(os.path.join(dirname, 'tar'))
     self._labeldb = LabelDB(os.path.join(dirname, 'label'))
+    self._mtimeidx = MtimeIndex(os.path.join(dirname, 'mtime'))
+    self._metadb = MetaDB(dirname)
+    self._digestidx = DigestIndex(os.path.join(dirname, 'digest'))
     Corpus.__init__(self, os.path.join(dirname, 'idx'), 'idx')
     return
 
@@ -253,6 +677,128 @@ class MailCorpus(Corpus):
   def get_labeldb(self):
     return self._labeldb
 
+  def get_mtime_ranges(self, t0, t1):
+    self._mtimeidx.update(self._db)
+    return self._mtimeidx.get_ranges(t0, t1)
+
+  def get_metadb(self):
+    self._metadb.update(self)
+    return self._metadb
+
+  def get_unsummarized(self):
+    # Returns the number of messages that get_metadb() has to
+    # read (and decompress) before it is usable.
+    n = len(self._metadb)
+    if len(self) < n:
+      return len(self)
+    return len(self)-n
+
+  def get_undigested(self):
+    # Returns the number of messages that find_duplicate() has
+    # to read (and decompress) before it can tell anything.
+    return self._digestidx.get_missing(self)
+
+  # Labels of the messages that cannot be an original: a message
+  # that we sent is not the original of its copy that comes back
+  # from a mailing list, and a copy of a deleted (or hidden
+  # duplicate) message is shown again as it is the only one left.
+  NONORIGINAL_LABELS = set([config.LABEL4SENT, config.LABEL4DELETED, config.LABEL4DUPLICATE])
+  def _get_originals(self, recnos):
+    return [ recno for recno in recnos
+             if not self.NONORIGINAL_LABELS.intersection(self.get_message_labels(str(recno))) ]
+
+  def find_duplicate(self, prepared):
+    # Returns the loc of the message that has the same digest
+    # as a prepared message, or None.
+    digest = prepared[4]
+    if digest == None:
+      return None
+    self._digestidx.update(self)
+    originals = self._get_originals(self._digestidx.lookup(digest))
+    if not originals:
+      return None
+    return str(originals[0])
+
+  def find_duplicates(self):
+    # Yields (loc, original_loc) of every duplicated message.
+    self._digestidx.update(self)
+    r = []
+    for recnos in self._digestidx.find_groups():
+      originals = self._get_originals(recnos)
+      for recno in originals[1:]:
+        r.append((recno, originals[0]))
+    for (recno,original) in sorted(r):
+      yield (str(recno), str(original))
+    return
+
+  def get_known_size(self):
+    # Returns the total size if the metadata covers every record.
+    if len(self._metadb) < len(self):
+      return None
+    return self._metadb.total_size()
+
+  def get_date_range(self):
+    self._mtimeidx.update(self._db)
+    if not self._mtimeidx.blocks:
+      return None
+    return (min( tmin for (tmin,_) in self._mtimeidx.blocks ),
+            max( tmax for (_,tmax) in self._mtimeidx.blocks ))
+
+  def get_segments(self):
+    return self._db.get_segments()
+
+  def get_exact_size(self, nprocs=None):
+    # Decompresses every record, one tar file per process.
+    from multiprocessing import Pool
+    pool = Pool(nprocs)
+    try:
+      sizes = pool.map(tarfile_uncompressed_size, self._db.get_segment_files())
+    finally:
+      pool.terminate()
+    return sum(sizes)
+
+  def count_labeled(self, preds, doc_preds):
+    '''
+    Counts the indexed messages that satisfy the given label (or
+    other msgid set) predicates and label filters, using the label
+    files and the metadata only.
+    Returns None if the query needs something other than labels.
+    '''
+    include = None
+    exclude = set()
+    for pred in preds:
+      if isinstance(pred, LabelPredicate):
+        msgids = self._labeldb.get_msgids(pred.label)
+      elif isinstance(pred, MsgidPredicate):
+        msgids = pred.msgids
+      else:
+        return None
+      if pred.neg:
+        exclude.update(msgids)
+      elif include is None:
+        include = set(msgids)
+      else:
+        include.intersection_update(msgids)
+    for pred in doc_preds:
+      if isinstance(pred, LabelBlock):
+        for label in pred.labels:
+          exclude.update(self._labeldb.get_msgids(label))
+      elif isinstance(pred, LabelPass):
+        for label in pred.labels:
+          msgids = self._labeldb.get_msgids(label)
+          if include is None:
+            include = set(msgids)
+          else:
+            include.intersection_update(msgids)
+      else:
+        return None
+    # Only the indexed messages can be found by a selection.
+    nindexed = int(self.index_lastloc() or '-1')+1
+    if include is None:
+      return nindexed - len([ msgid for msgid in exclude if msgid < nindexed ])
+    include.difference_update(exclude)
+    return len([ msgid for msgid in include if msgid < nindexed ])
+
   def open(self, mode='r'):
     try:
       self._db.open(mode)
@@ -293,6 +839,9 @@ class MailCorpus(Corpus):
     self.mode = None
     self._db.close()
     self._labeldb.close()
+    self._mtimeidx.close()
+    self._metadb.close()
+    self._digestidx.close()
     return
   
   def get_message(self, loc):
@@ -301,17 +850,52 @@ class MailCorpus(Corpus):
     data = fp.read()
     fp.close()
     return data
+
+  # iter_message: yields the message data in pieces of at most
+  # bufsize bytes while decompressing it.
+  def iter_message(self, loc, bufsize=65536):
+    import zlib
+    (info, fp) = self._db.get_record_file(int(loc))
+    # Decompress gzip.
+    z = zlib.decompressobj(16+zlib.MAX_WBITS)
+    while 1:
+      data = fp.read(bufsize)
+      if not data: break
+      while data:
+        s = z.decompress(data, bufsize)
+        if s:
+          yield s
+        data = z.unconsumed_tail
+    s = z.flush()
+    if s:
+      yield s
+    return
     
-  def add_message(self, data, labels, mtime=0):
-    import time
-    info = TarInfo(self._labels2name(len(self._db), labels))
-    info.mtime = mtime or int(time.time())
+  # prepare_message: does the part of add_message that does not
+  # touch the database, so that it can be run in parallel.
+  @staticmethod
+  def prepare_message(data):
+    from utils import get_mime_summary, get_message_digest
     fp = StringIO.StringIO()
     gz = gzip.GzipFile(mode='w', fileobj=fp)
     gz.write(data)
     gz.close()
-    recno = self._db.add_record(info, fp.getvalue())
+    (types, nattach) = get_mime_summary(data)
+    return (fp.getvalue(), len(data), nattach, types, get_message_digest(data))
+
+  def add_message(self, data, labels, mtime=0):
+    return self.add_prepared_message(self.prepare_message(data), labels, mtime)
+
+  def add_prepared_message(self, prepared, labels, mtime=0):
+    import time
+    (zdata, size, nattach, types, digest) = prepared
+    info = TarInfo(self._labels2name(len(self._db), labels))
+    info.mtime = mtime or int(time.time())
+    recno = self._db.add_record(info, zdata)
     self._labeldb.add_label(recno, labels)
+    self._mtimeidx.add(recno, info.mtime)
+    self._metadb.add(recno, size, nattach, types)
+    self._digestidx.add(recno, digest)
     self._last_unindexed_loc = str(recno)
     return self._last_unindexed_loc
 
@@ -368,6 +952,9 @@ class MailCorpus(Corpus):
     return info.mtime
 
   def loc_size(self, loc):
+    recno = int(loc)
+    if recno < len(self._metadb):
+      return self._metadb.get_size(recno)
     return len(self.get_message(loc))
 
   def get_doc(self, loc):
@@ -375,23 +962,51 @@ class MailCorpus(Corpus):
     return EMailDocumentWithLabel(self, loc, info.mtime)
 
 
+# tarfile_uncompressed_size:
+# returns the total uncompressed size of the records in a tar file.
+def tarfile_uncompressed_size(fname, chunksize=65536):
+  import zlib
+  from tarfile import BLOCKSIZE
+  total = 0
+  fp = file(fname, 'rb')
+  while 1:
+    buf = fp.read(BLOCKSIZE)
+    if len(buf) != BLOCKSIZE: break
+    try:
+      info = TarInfo.frombuf(buf)
+    except ValueError:
+      break
+    data = fp.read(info.size)
+    fp.seek(-info.size % BLOCKSIZE, 1)
+    # Decompress the record in chunks (with the gzip header).
+    z = zlib.decompressobj(16+zlib.MAX_WBITS)
+    while data:
+      total += len(z.decompress(data, chunksize))
+      data = z.unconsumed_tail
+    total += len(z.flush())
+  fp.close()
+  return total
+
+
 # main: 
 def main(argv):
   import getopt
   def usage():
     print 'usage: %s create dbpath' % argv[0]
-    print 'usage: %s [-v] info dbpath' % argv[0]
+    print 'usage: %s [-v] [--exact] info dbpath' % argv[0]
     print 'usage: %s [-m] get dbpath msgid ...' % argv[0]
     return 100
   try:
-    (opts, args) = getopt.getopt(argv[1:], 'vm')
+    (opts, args) = getopt.getopt(argv[1:], 'vm', ['exact'])
   except getopt.GetoptError:
     return usage()
   verbose = 0
   mbox = False
+  exact = False
   for (k, v) in opts:
     if k == '-v': verbose += 1
     elif k == '-m': mbox = True
+    elif k == '--exact': exact = True
   if len(args) < 2:
     return usage()
   cmd = args.pop(0)
@@ -416,11 +1031,30 @@ def main(argv):
     # info
     corpus = MailCorpus(os.path.join(dirname, 'inbox'))
     corpus.open()
+    import time
     print len(corpus), 'messages'
-    total = 0
-    for loc in xrange(len(corpus)):
-      total += corpus.loc_size(loc)
-    print total, 'bytes in total'
+    for (name, nrecords, datasize, filesize) in corpus.get_segments():
+      print '  %s: %d messages, %d bytes compressed (%d bytes on disk)' % \
+            (name, nrecords, datasize, filesize)
+    r = corpus.get_date_range()
+    if r:
+      (t0, t1) = r
+      print 'from', time.ctime(t0), 'to', time.ctime(t1)
+    labeldb = corpus.get_labeldb()
+    for label in labeldb.list_labels():
+      n = len(labeldb.get_msgids(label))
+      if n:
+        print '  %s: %d messages' % (config.LABELS.get(label, label), n)
+    nindexed = int(corpus.index_lastloc() or '-1')+1
+    print nindexed, 'messages indexed,', len(corpus)-nindexed, 'not indexed'
+    if exact:
+      total = corpus.get_exact_size()
+    else:
+      total = corpus.get_known_size()
+    if total == None:
+      print 'total size unknown (use --exact)'
+    else:
+      print total, 'bytes in total'
     corpus.close()
     
   elif cmd == 'get':
@@ -5,7 +5,8 @@ from utils import rmsp, get_msgids, get_numbers, \
      unicode_header, unicode_getall, unicode_getalladdrs, \
      encode_header, formataddr, formatdate, \
      get_message_part, get_body_text, enum_message_parts, msg_repr, make_msgid, \
-     validate_message_structure, MessageStructureError
+     get_part_index, invalidate_part_index, \
+     validate_message_structure, MessageStructureError, MessagePartNotFoundError
 
 
 ##  Internal functions
@@ -24,13 +25,58 @@ def get_label_names(labels):
 
 # show line with highlights
 def highlight(term, selection, color, line):
-  s = ''
-  for (state,x) in selection.matched_range(line):
-    if state:
-      s += term.color(config.COLOR4HIGHLIGHT, x)
-    else:
-      s += term.color(color, x)
-  return s
+  return Highlighter(term, selection).highlight(color, line)
+
+
+##  Highlighter
+##
+##  Colors the text matched by a selection. Lines are matched
+##  in chunks of CHUNK_LINES with one call of matched_range()
+##  and the matched ranges are split back into lines.
+##
+class Highlighter:
+
+  CHUNK_LINES = 100
+
+  def __init__(self, term, selection):
+    self.term = term
+    self.selection = selection
+    return
+
+  def __repr__(self):
+    return '<Highlighter: selection=%r>' % self.selection
+
+  def highlight(self, color, line):
+    return ''.join(self.iter_lines(color, [line]))
+
+  def iter_lines(self, color, lines):
+    from itertools import islice
+    lines = iter(lines)
+    while 1:
+      chunk = list(islice(lines, self.CHUNK_LINES))
+      if not chunk: break
+      for s in self.highlight_chunk(color, chunk):
+        yield s
+    return
+
+  def highlight_chunk(self, color, lines):
+    term = self.term
+    r = []
+    for (state,x) in self.selection.matched_range(u'\n'.join(lines)):
+      if state:
+        c = config.COLOR4HIGHLIGHT
+      else:
+        c = color
+      pieces = x.split(u'\n')
+      for x in pieces[:-1]:
+        if x:
+          r.append(term.color(c, x))
+        yield ''.join(r)
+        r = []
+      if pieces[-1]:
+        r.append(term.color(c, pieces[-1]))
+    yield ''.join(r)
+    return
 
 
 ##  show_digest
@@ -66,12 +112,10 @@ def show_digest(term, idx, focused, doc, selection, labels):
 
   # truncate
   def trunc(n, s0):
-    length = 0
-    for (i,c) in enumerate(s0):
-      length += term.length(c)
-      if n <= length+2:
-        return s0[:i+1]+'.'*(n-length)
-    return s0
+    (s, length) = term.truncate(s0, n-2)
+    if s == s0 and length < n-2:
+      return s0
+    return s+'.'*(n-length)
 
   # Creata a line bufffer.
   width = term.cols or 80
@@ -81,7 +125,7 @@ def show_digest(term, idx, focused, doc, selection, labels):
   if labels:
     line += ' [%s]' % (get_label_names(labels))
   line += ' '+trunc(40, doc.get_title())
-  left = width-len(line)-4
+  left = width-term.length(line)-4
   line += ' >> '+doc.get_snippet(selection, maxchars=left, maxcontext=left)
   line = trunc(width-4, line)
 
@@ -95,9 +139,9 @@ def show_digest(term, idx, focused, doc, selection, labels):
 
 ##  show_message
 ##
-MAX_PP_SIZE = 100000
 def show_message(term, idx, doc, selection,
                  showall=False, needpager=False, headerlevel=0, verbose=True):
+  from interface import Interface
 
   # lines left
   if term.lines and not showall:
@@ -141,31 +185,6 @@ def show_message(term, idx, doc, selection,
   def get_header_color(x):
     return config.HEADER_COLOR.get(x.lower(), '')
 
-  # fold_text
-  def fold_text(term, text, indent2=''):
-    from kinsoku import WORD_PAT
-    if not term.cols:
-      for line in text.splitlines():
-        yield line
-      return
-    width = term.cols-4
-    for line in text.splitlines():
-      s = ''
-      l0 = len(s)
-      i = 0
-      for m in WORD_PAT.finditer(line):
-        w = m.group(0)
-        l1 = term.length(w)
-        if i and (width < l0+l1):
-          yield s
-          s = indent2
-          l0 = len(s)
-        s += w
-        l0 += l1
-        i = 1
-      yield s
-    return
-
   # show contents.
   def genlines(msg):
     charset = msg.get_content_charset(config.MESSAGE_CHARSET)
@@ -178,21 +197,15 @@ def show_message(term, idx, doc, selection,
         for (h,v) in get_headers(mpart):
           s = '%s: %s' % (h, rmsp(v))
           color = config.HEADER_COLOR.get(h.lower(), '')
-          for line in fold_text(term, s, indent2='    '):
-            yield highlight(term, selection, color, line.rstrip())
+          lines = ( line.rstrip() for line in fold_text(s, indent2='    ') )
+          for line in highlighter.iter_lines(color, lines):
+            yield line
         yield ''
       # Show the payload.
       if mpart.get_content_maintype() == 'text':
-        r = u''
         text = get_body_text(mpart, charset)
-        if MAX_PP_SIZE < len(text):
-          for line in text.splitlines():
-            yield term.normal(line)
-        else:
-          for line in fold_text(term, text):
-            r += line+'\n'
-          for line in highlight(term, selection, '', r).splitlines():
-            yield line
+        for line in highlighter.iter_lines('', fold_text(text)):
+          yield line
       yield ''
     return
 
@@ -200,6 +213,15 @@ def show_message(term, idx, doc, selection,
   if needpager:
     term = term.open_pager()
 
+  # fold_text
+  if term.cols:
+    from kinsoku import TextFolder
+    fold_text = TextFolder(term.cols-4, term.length).fold
+  else:
+    def fold_text(text, indent2=''):
+      return text.splitlines()
+  highlighter = Highlighter(term, selection)
+
   if verbose:
     labels = doc.get_labels()
     term.display(term.color(get_message_color(labels),
@@ -211,22 +233,26 @@ def show_message(term, idx, doc, selection,
     lines -= len(trees)
 
   empty = False
-  for line in genlines(msg0):
-    if lines < 0:
-      term.warning('(continued)')
-      break
-    if not line.strip():
-      if not empty:
-        term.display('\n')
-        empty = True
-        lines -= 1
-    else:
-      term.display(line+'\n')
-      empty = False
-      lines -= line.count('\n')+1
+  try:
+    for line in genlines(msg0):
+      if lines < 0:
+        term.warning('(continued)')
+        break
+      if not line.strip():
+        if not empty:
+          term.display('\n')
+          empty = True
+          lines -= 1
+      else:
+        term.display(line+'\n')
+        empty = False
+        lines -= line.count('\n')+1
 
-  for line in trees:
-    term.display(term.color(config.COLOR4MIMETREE, line)+'\n')
+    for line in trees:
+      term.display(term.color(config.COLOR4MIMETREE, line)+'\n')
+  except Interface.PagerClosed:
+    # The rest is not wanted.
+    pass
 
   if needpager:
     term.wait_finish()
@@ -235,8 +261,7 @@ def show_message(term, idx, doc, selection,
 
 ##  show_mime_part
 ##
-def show_mime_part(term, msg, part, headerlevel=0, charset=None):
-  mpart = get_message_part(msg, part)
+def show_mime_part(term, mpart, headerlevel=0, charset=None):
   
   # Binary - might get InterfaceError.
   if mpart.get_content_type() != 'text/plain':
@@ -250,8 +275,7 @@ def show_mime_part(term, msg, part, headerlevel=0, charset=None):
       term.display(term.normal('%s: %s\n' % (h, rmsp(v))))
     term.display('\n')
 
-  charset = msg.get_content_charset(charset or config.MESSAGE_CHARSET)
-  term.display(term.normal(get_body_text(mpart, charset)))
+  term.display(term.normal(get_body_text(mpart, charset or config.MESSAGE_CHARSET)))
   return
 
 
@@ -444,10 +468,85 @@ def create_message(corpus, data, msg0=None):
 
 ##  send_message
 ##
-class MessageTransportError(IOError): pass
+class MessageTransportError(IOError):
+  # permanent is True if the server rejected the message (5xx).
+  permanent = False
+
+##  SMTPSession
+##
+##  Keeps one (authenticated) SMTP connection for several messages.
+##  A connection that has been dropped by the server is replaced
+##  before the next message is sent.
+##
+class SMTPSession:
+
+  def __init__(self, host=None):
+    self.host = host or config.SMTP_HOST
+    self.smtp = None
+    self.nsent = 0
+    return
+
+  def __repr__(self):
+    return '<SMTPSession: host=%r, connected=%r, nsent=%r>' % \
+           (self.host[:2], self.smtp != None, self.nsent)
 
-def send_message(msg, fromaddr, rcpts):
-  import time, smtplib
+  def connect(self):
+    import smtplib
+    (host, port, user, password, tls) = self.host
+    smtp = smtplib.SMTP()
+    smtp.connect(host, port)
+    if tls:
+      smtp.ehlo()
+      smtp.starttls()
+      smtp.ehlo()
+    if user and password:
+      smtp.login(user, password)
+    self.smtp = smtp
+    return
+
+  def is_alive(self):
+    import smtplib, socket
+    try:
+      return self.smtp.noop()[0] == 250
+    except (smtplib.SMTPException, socket.error):
+      return False
+
+  def sendmail(self, fromaddr, rcpts, data):
+    import smtplib, socket
+    try:
+      if self.smtp and not self.is_alive():
+        self.close()
+      if not self.smtp:
+        self.connect()
+      self.smtp.sendmail(fromaddr, rcpts, data)
+    except (smtplib.SMTPException, socket.error), e:
+      if isinstance(e, (smtplib.SMTPServerDisconnected, socket.error)):
+        self.close()
+      err = MessageTransportError(str(e))
+      if isinstance(e, smtplib.SMTPRecipientsRefused):
+        # Permanent only if every recipient is refused for good.
+        codes = [ code for (code,_) in e.recipients.itervalues() ]
+        err.permanent = bool(codes) and (500 <= min(codes))
+      else:
+        err.permanent = (500 <= getattr(e, 'smtp_code', 0))
+      raise err
+    self.nsent += 1
+    return
+
+  def close(self):
+    import smtplib, socket
+    if self.smtp:
+      try:
+        self.smtp.quit()
+      except (smtplib.SMTPException, socket.error):
+        self.smtp.close()
+      self.smtp = None
+    return
+
+# finalize_message: assigns the Message-ID and the date,
+# removes Bcc and empty headers and returns the message text.
+def finalize_message(msg):
+  import time
   def getlogin():
     import os
     if hasattr(os, 'getlogin'):
@@ -471,22 +570,20 @@ def send_message(msg, fromaddr, rcpts):
   for (k,v) in msg.items():
     if not rmsp(v):
       del msg[k]
-  data = msg_repr(msg)
-  # Send the message.
-  smtp = smtplib.SMTP()
-  (host, port, user, password, tls) = config.SMTP_HOST
-  try:
-    smtp.connect(host, port)
-    if tls:
-      smtp.ehlo()
-      smtp.starttls()
-      smtp.ehlo()
-    if user and password:
-      smtp.login(user, password)
-    smtp.sendmail(fromaddr, rcpts, data)
-  except smtplib.SMTPException, e:
-    raise MessageTransportError(str(e))
-  smtp.close()
+  return msg_repr(msg)
+
+# send_message: sends a message through the session
+# (or a new connection if no session is given).
+def send_message(msg, fromaddr, rcpts, session=None):
+  data = finalize_message(msg)
+  if session:
+    session.sendmail(fromaddr, rcpts, data)
+  else:
+    session = SMTPSession()
+    try:
+      session.sendmail(fromaddr, rcpts, data)
+    finally:
+      session.close()
   return data
 
 
@@ -550,6 +647,7 @@ def mime_add(msg, obj):
   if msg.is_multipart():
     # This is already multipart.
     msg.attach(obj)
+    invalidate_part_index(msg)
     return msg
 
   # If not, wrap the original Message with a new Multipart object.
@@ -584,17 +682,21 @@ def mime_add(msg, obj):
 ##
 def mime_alter(msg, part, obj):
   validate_message_structure(msg)
-  # Get the old object to be replaced.
-  mpart = get_message_part(msg, part)
-  # Get the list of the children of the parent object.
-  children = msg.get_payload()
-  if mpart not in children:
+  # Get the position of the old object to be replaced.
+  for (n,path,_,_,_,_,_,_) in get_part_index(msg):
+    if n == part: break
+  else:
+    raise MessagePartNotFoundError(msg, part)
+  # It must be a child of the root.
+  if len(path) != 1:
     raise MessageStructureError('Cannot change that part.')
-  i = children.index(mpart)
+  i = path[0]
   if i == 0:
     raise MessageStructureError('Cannot change the first text part.')
+  children = msg.get_payload()
   # Replace it with a new one.
   children[i] = obj
+  invalidate_part_index(msg)
   return msg
 
 
@@ -603,15 +705,19 @@ def mime_alter(msg, part, obj):
 ##
 def mime_del(msg, part):
   validate_message_structure(msg)
-  # Get the old object to be removed.
-  mpart = get_message_part(msg, part)
-  # Get the list of the children of the parent object.
-  children = msg.get_payload()
-  if mpart not in children:
+  # Get the position of the old object to be removed.
+  for (n,path,_,_,_,_,_,_) in get_part_index(msg):
+    if n == part: break
+  else:
+    raise MessagePartNotFoundError(msg, part)
+  # It must be a child of the root.
+  if len(path) != 1:
     raise MessageStructureError('Cannot remove that part.')
-  i = children.index(mpart)
+  i = path[0]
   if i == 0:
     raise MessageStructureError('Cannot remove the first text part.')
+  children = msg.get_payload()
   # Remove it.
-  children.remove(mpart)
+  del children[i]
+  invalidate_part_index(msg)
   return msg
@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+##
+##  mimestream.py - streaming extraction of MIME parts
+##
+##
+##  Usage:
+##
+##   # saving the 2nd part (base:1) of a message without
+##   # holding the whole message in memory.
+##   (headers, body) = open_part(corpus.iter_message(loc), 2)
+##   print headers.get_filename()
+##   fp = file('out', 'wb')
+##   for data in body:
+##     fp.write(data)
+##   fp.close()
+##
+##  The parts are numbered in the same way as msg.walk() does.
+##  Only the data up to the end of the part is read.
+##
+
+import sys, re, binascii
+stderr = sys.stderr
+
+class PartNotFound(ValueError): pass
+class Unsupported(ValueError): pass
+class DecodeError(ValueError): pass
+
+
+# iter_lines: splits pieces of data into lines (with line ends).
+# The pieces of an unfinished line are kept in a list and joined
+# only when its line end arrives.
+def iter_lines(chunks):
+  rest = []
+  for data in chunks:
+    rest.append(data)
+    if '\n' not in data: continue
+    lines = ''.join(rest).split('\n')
+    rest = [lines.pop()]
+    for line in lines:
+      yield line+'\n'
+  rest = ''.join(rest)
+  if rest:
+    yield rest
+  return
+
+
+##  Decoders
+##
+##  Each decoder takes lines of encoded data and returns
+##  the decoded data.
+##
+class RawDecoder:
+
+  def feed(self, data):
+    return data
+
+  def flush(self):
+    return ''
+
+class Base64Decoder(RawDecoder):
+
+  NONBASE64 = re.compile(r'[^A-Za-z0-9+/=]+')
+
+  def __init__(self):
+    self.buf = ''
+    return
+
+  def feed(self, data):
+    data = self.buf+self.NONBASE64.sub('', data)
+    n = len(data)/4*4
+    self.buf = data[n:]
+    try:
+      return binascii.a2b_base64(data[:n])
+    except binascii.Error, e:
+      raise DecodeError('base64: %s' % e)
+
+  def flush(self):
+    try:
+      return binascii.a2b_base64(self.buf)
+    except binascii.Error:
+      # Incomplete data.
+      return ''
+
+class QPDecoder(RawDecoder):
+
+  def feed(self, data):
+    return binascii.a2b_qp(data)
+
+DECODERS = {
+  'base64': Base64Decoder,
+  'quoted-printable': QPDecoder,
+  }
+UNSUPPORTED_ENCODINGS = ('x-uuencode', 'uuencode', 'uue', 'x-uue')
+
+
+##  PartReader
+##
+##  Reads a message line by line, keeping the boundaries of the
+##  enclosing multiparts so that a part ends at any of them.
+##
+class PartReader:
+
+  HEADER_PAT = re.compile(r'^(From |[\041-\071\073-\176]+:|[\t ])')
+  EOL_PAT = re.compile(r'\r?\n$|\r$')
+  BUFSIZE = 65536
+
+  def __init__(self, chunks):
+    self.lines = iter_lines(chunks)
+    self.pending = None
+    self.delimiters = []
+    self.nparts = 0
+    return
+
+  def __repr__(self):
+    return '<PartReader: nparts=%d, delimiters=%d>' % (self.nparts, len(self.delimiters))
+
+  def peek(self):
+    if self.pending == None:
+      try:
+        self.pending = self.lines.next()
+      except StopIteration:
+        pass
+    return self.pending
+
+  def readline(self):
+    # Returns the next line or None at a boundary or at the end.
+    line = self.peek()
+    if line == None: return None
+    if line.startswith('--'):
+      for pat in self.delimiters:
+        if pat.match(line): return None
+    self.pending = None
+    return line
+
+  def read_delimiter(self, pat):
+    # Reads a delimiter of the current multipart.
+    # Returns 'next', 'close' or None (at an outer boundary).
+    line = self.peek()
+    if line == None: return None
+    m = pat.match(line)
+    if not m: return None
+    self.pending = None
+    if m.group(1): return 'close'
+    return 'next'
+
+  def read_headers(self, default_type):
+    from email.Parser import HeaderParser
+    lines = []
+    while 1:
+      line = self.readline()
+      if line == None: break
+      if not line.strip():
+        # The end of the headers.
+        break
+      if not self.HEADER_PAT.match(line):
+        # The body without a blank line.
+        self.pending = line
+        break
+      lines.append(line)
+    headers = HeaderParser().parsestr(''.join(lines))
+    headers.set_default_type(default_type)
+    return headers
+
+  def skip(self):
+    while self.readline() != None:
+      pass
+    return
+
+  def find(self, n, default_type='text/plain'):
+    # Returns (headers, body) of the n-th part or None.
+    headers = self.read_headers(default_type)
+    maintype = headers.get_content_maintype()
+    if maintype == 'message':
+      if headers.get_content_subtype() == 'delivery-status':
+        raise Unsupported(headers.get_content_type())
+      # The body is a message.
+      return self.find(n)
+    if maintype != 'multipart':
+      self.nparts += 1
+      if self.nparts == n:
+        return (headers, self.iter_body(headers))
+      self.skip()
+      return None
+    boundary = headers.get_boundary()
+    if not boundary:
+      raise Unsupported('No boundary: %s' % headers.get_content_type())
+    if headers.get_content_type() == 'multipart/digest':
+      default_type = 'message/rfc822'
+    else:
+      default_type = 'text/plain'
+    pat = re.compile(r'--'+re.escape(boundary)+r'(--)?[ \t]*(?:\r\n|\r|\n)?$')
+    # (The boundary is kept while the body of a found part is read.)
+    self.delimiters.append(pat)
+    # Skip the preamble.
+    self.skip()
+    delimiter = self.read_delimiter(pat)
+    if delimiter == None:
+      raise Unsupported('No boundary found: %r' % boundary)
+    while delimiter == 'next':
+      r = self.find(n, default_type)
+      if r: return r
+      delimiter = self.read_delimiter(pat)
+    self.delimiters.pop()
+    # Skip the epilogue.
+    self.skip()
+    return None
+
+  def iter_body(self, headers):
+    cte = str(headers.get('content-transfer-encoding', '')).lower()
+    if cte in UNSUPPORTED_ENCODINGS:
+      raise Unsupported(cte)
+    decoder = DECODERS.get(cte, RawDecoder)()
+    # The last line is kept until we know if it is followed by
+    # a boundary, which owns the line break before it.
+    (lines, size, last) = ([], 0, None)
+    while 1:
+      line = self.readline()
+      if line == None: break
+      if last != None:
+        lines.append(last)
+        size += len(last)
+        if self.BUFSIZE <= size:
+          yield decoder.feed(''.join(lines))
+          (lines, size) = ([], 0)
+      last = line
+    if last != None:
+      if self.peek() != None:
+        last = self.EOL_PAT.sub('', last)
+      lines.append(last)
+    yield decoder.feed(''.join(lines))
+    yield decoder.flush()
+    return
+
+
+# open_part: returns (headers, body) of the n-th part (base:1)
+# of a message given as pieces of data. headers is a Message
+# object without the payload and body yields the decoded data.
+def open_part(chunks, n):
+  r = PartReader(chunks).find(n)
+  if not r:
+    raise PartNotFound(n)
+  (headers, body) = r
+  # Start reading so that an unsupported part is reported here.
+  body = iter(body)
+  first = body.next()
+  def iter_all():
+    yield first
+    for data in body:
+      yield data
+    return
+  return (headers, iter_all())
+
+
+# unittests
+if __name__ == '__main__':
+  import unittest
+  from email import message_from_string
+  from email.MIMEMultipart import MIMEMultipart
+  from email.MIMEText import MIMEText
+  from email.MIMEBase import MIMEBase
+  from email.MIMEMessage import MIMEMessage
+  from email import Encoders
+
+  def split(data, size):
+    return [ data[i:i+size] for i in xrange(0, len(data), size) ]
+
+  class MIMEStreamTest(unittest.TestCase):
+
+    def assertSameParts(self, data, chunksize=7):
+      msg = message_from_string(data)
+      parts = [ m for m in msg.walk() if not m.is_multipart() ]
+      for (i,mpart) in enumerate(parts):
+        (headers, body) = open_part(split(data, chunksize), i+1)
+        self.assertEqual(headers.items(), mpart.items())
+        self.assertEqual(''.join(body), mpart.get_payload(decode=True))
+      self.assertRaises(PartNotFound, open_part, split(data, chunksize), len(parts)+1)
+      return
+
+    def test_simple(self):
+      self.assertSameParts('Subject: a\n\nhello\nworld\n')
+      self.assertSameParts('Subject: a\n')
+      self.assertSameParts('Subject: a\r\nContent-Transfer-Encoding: quoted-printable\r\n\r\nx=3Dy=\r\nz\r\n')
+      return
+
+    def test_multipart(self):
+      msg = MIMEMultipart()
+      msg.preamble = 'preamble\n'
+      msg.epilogue = 'epilogue\n'
+      msg.attach(MIMEText('text\npart\n'))
+      alt = MIMEMultipart('alternative')
+      alt.attach(MIMEText('plain'))
+      alt.attach(MIMEText('<b>html</b>', 'html'))
+      msg.attach(alt)
+      obj = MIMEBase('application', 'octet-stream')
+      obj.set_payload(''.join( chr(i % 256) for i in xrange(100000) )+'x')
+      Encoders.encode_base64(obj)
+      msg.attach(obj)
+      msg.attach(MIMEMessage(MIMEText('attached message')))
+      qp = MIMEText('')
+      qp.set_payload('long line '*20)
+      Encoders.encode_quopri(qp)
+      msg.attach(qp)
+      data = msg.as_string()
+      self.assertSameParts(data)
+      self.assertSameParts(data.replace('\n', '\r\n'), 1000)
+      return
+
+    def test_lazy(self):
+      # The data after the part is not read.
+      msg = MIMEMultipart()
+      msg.attach(MIMEText('first'))
+      msg.attach(MIMEText('second'))
+      data = msg.as_string()
+      i = data.index('second')
+      def chunks():
+        yield data[:i+100]
+        raise AssertionError('read too much')
+      (_, body) = open_part(chunks(), 1)
+      self.assertEqual(''.join(body), 'first')
+      return
+
+    def test_long_line(self):
+      data = 'Subject: a\n\n'+'x'*100000+'\ny\n'
+      self.assertSameParts(data, 3)
+      self.assertEqual(list(iter_lines(['a', 'b', 'c\nd', 'e'])), ['abc\n', 'de'])
+      return
+
+    def test_corrupt(self):
+      data = 'Content-Transfer-Encoding: base64\n\nQUJD\nQ===\n'
+      self.assertRaises(DecodeError, open_part, [data], 1)
+      # An error after the first piece is raised while reading.
+      data = 'Content-Transfer-Encoding: base64\n\n'+'QUJD\n'*20000+'Q===\n'
+      (_, body) = open_part([data], 1)
+      self.assertRaises(DecodeError, list, body)
+      return
+
+    def test_unsupported(self):
+      data = 'Content-Type: multipart/mixed\n\nno boundary\n'
+      self.assertRaises(Unsupported, open_part, [data], 1)
+      data = 'Content-Transfer-Encoding: x-uuencode\n\nbegin 644 x\n'
+      self.assertRaises(Unsupported, open_part, [data], 1)
+      return
+
+  unittest.main()
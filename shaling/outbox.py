@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+##
+##  outbox.py - queue of outgoing messages
+##
+##
+##  Usage:
+##
+##   # queueing a message
+##   outbox = Outbox(config.OUTBOX_DIR)
+##   outbox.put(fromaddr, rcpts, data)
+##   start_worker()  # delivers it in the background.
+##
+##   # delivering the queued messages (in the foreground)
+##   outbox.deliver()
+##
+
+import sys, os, os.path, time, pickle
+from itertools import count
+from message import SMTPSession, MessageTransportError
+import config
+stderr = sys.stderr
+
+
+##  DeliveryLock
+##
+##  An flock(2) on a file. Unlike the rename-based FileLock, it
+##  is released by the system when the process holding it dies,
+##  so a killed worker does not block the deliveries forever.
+##
+class DeliveryLock:
+
+  class Failed(Exception): pass
+
+  def __init__(self, fname):
+    self.fname = fname
+    self.fp = None
+    return
+
+  def __repr__(self):
+    return '<DeliveryLock: %r, locked=%r>' % (self.fname, self.fp != None)
+
+  def acquire(self):
+    import fcntl
+    if self.fp != None:
+      raise DeliveryLock.Failed('already acquired: %r' % self)
+    fp = file(self.fname, 'a')
+    try:
+      fcntl.flock(fp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+      fp.close()
+      raise DeliveryLock.Failed('failed to acquire: %r' % self)
+    self.fp = fp
+    return
+
+  def release(self):
+    if self.fp == None:
+      raise DeliveryLock.Failed('not acquired: %r' % self)
+    # Closing the file releases the lock.
+    self.fp.close()
+    self.fp = None
+    return
+
+
+##  Outbox
+##
+##  Each queued message is a pickled (fromaddr, rcpts, data, attempts,
+##  error) in a file whose name starts with the time of its next
+##  delivery attempt. A failed attempt is retried later with
+##  exponential backoff; messages that cannot be delivered at all
+##  are moved to the failed/ subdirectory.
+##
+class Outbox:
+
+  class OutboxError(Exception): pass
+  class Busy(OutboxError): pass
+
+  MAX_ATTEMPTS = 8
+  BACKOFF = 60
+  NWORKERS = 4
+
+  _seqno = count()
+
+  def __init__(self, dirname):
+    self.dirname = dirname
+    self.faileddir = os.path.join(dirname, 'failed')
+    for d in (self.dirname, self.faileddir):
+      if not os.path.isdir(d):
+        os.makedirs(d)
+    self.lock = DeliveryLock(os.path.join(dirname, 'lock'))
+    return
+
+  def __repr__(self):
+    return '<Outbox: dirname=%r, lock=%r>' % (self.dirname, self.lock)
+
+  # Internal routines.
+  def _save(self, dirname, t, entry):
+    name = '%017.6f-%d-%d.msg' % (t, os.getpid(), self._seqno.next())
+    fname = os.path.join(dirname, name)
+    fp = file(fname+'.tmp', 'wb')
+    pickle.dump(entry, fp, 2)
+    fp.close()
+    os.rename(fname+'.tmp', fname)
+    return name
+
+  def _load(self, fname):
+    fp = file(fname, 'rb')
+    entry = pickle.load(fp)
+    fp.close()
+    return entry
+
+  def _names(self, dirname):
+    return sorted( name for name in os.listdir(dirname) if name.endswith('.msg') )
+
+  def _time(self, name):
+    return float(name.split('-')[0])
+
+  def put(self, fromaddr, rcpts, data):
+    return self._save(self.dirname, time.time(), (fromaddr, rcpts, data, 0, None))
+
+  def get_pending(self):
+    # Returns [(name, next_time), ...] in the order of delivery.
+    return [ (name, self._time(name)) for name in self._names(self.dirname) ]
+
+  def list_messages(self):
+    '''
+    Returns [(failed, next_time, fromaddr, rcpts, attempts, error), ...].
+    '''
+    r = []
+    for (failed,dirname) in ((False, self.dirname), (True, self.faileddir)):
+      for name in self._names(dirname):
+        try:
+          (fromaddr, rcpts, data, attempts, error) = self._load(os.path.join(dirname, name))
+        except (IOError, OSError):
+          continue
+        r.append((failed, self._time(name), fromaddr, rcpts, attempts, error))
+    return r
+
+  def retry_failed(self):
+    # Puts the failed messages back to the queue.
+    n = 0
+    for name in self._names(self.faileddir):
+      fname = os.path.join(self.faileddir, name)
+      (fromaddr, rcpts, data, attempts, error) = self._load(fname)
+      self._save(self.dirname, time.time(), (fromaddr, rcpts, data, 0, error))
+      os.unlink(fname)
+      n += 1
+    return n
+
+  def send1(self, session, name):
+    # Tries to deliver one message. Returns True if it is sent.
+    from utils import log
+    fname = os.path.join(self.dirname, name)
+    (fromaddr, rcpts, data, attempts, error) = self._load(fname)
+    try:
+      session.sendmail(fromaddr, rcpts, data)
+    except MessageTransportError, e:
+      attempts += 1
+      log('outbox: %s: %r: %s (attempt %d)' % (name, rcpts, e, attempts))
+      if e.permanent or self.MAX_ATTEMPTS <= attempts:
+        self._save(self.faileddir, time.time(), (fromaddr, rcpts, data, attempts, str(e)))
+      else:
+        t = time.time() + self.BACKOFF * 2**(attempts-1)
+        self._save(self.dirname, t, (fromaddr, rcpts, data, attempts, str(e)))
+      os.unlink(fname)
+      return False
+    log('outbox: %s: sent to %r' % (name, rcpts))
+    os.unlink(fname)
+    return True
+
+  def deliver(self, nworkers=NWORKERS, wait=False, idle=0):
+    '''
+    Sends the queued messages with nworkers connections.
+    If wait is True, waits for the messages that are to be retried
+    later. Messages that are queued meanwhile are also delivered.
+    The connections are kept for idle seconds after the queue
+    becomes empty. Returns (nsent, nfailed).
+    '''
+    import threading, Queue
+    try:
+      self.lock.acquire()
+    except DeliveryLock.Failed:
+      raise Outbox.Busy('Another delivery is running: %r' % self.dirname)
+    jobs = Queue.Queue()
+    done = Queue.Queue()
+
+    def worker():
+      session = SMTPSession()
+      try:
+        while 1:
+          name = jobs.get()
+          if name == None: break
+          try:
+            done.put((name, self.send1(session, name)))
+          except Exception, e:
+            done.put((name, e))
+      finally:
+        session.close()
+      return
+
+    threads = [ threading.Thread(target=worker) for _ in xrange(nworkers) ]
+    for t in threads:
+      t.setDaemon(True)
+      t.start()
+    (nsent, nfailed) = (0, 0)
+    inprogress = set()
+    idle_since = None
+    try:
+      while 1:
+        now = time.time()
+        pending = [ (name,t) for (name,t) in self.get_pending() if name not in inprogress ]
+        for (name,t) in pending:
+          if now < t: break
+          inprogress.add(name)
+          jobs.put(name)
+        waiting = [ t for (name,t) in pending if now < t ]
+        if not inprogress and not (wait and waiting):
+          # Nothing to do.
+          if idle_since == None:
+            idle_since = now
+          if idle <= now-idle_since: break
+        else:
+          idle_since = None
+        try:
+          (name, result) = done.get(True, 1.0)
+        except Queue.Empty:
+          continue
+        inprogress.discard(name)
+        if isinstance(result, Exception):
+          raise result
+        if result:
+          nsent += 1
+        else:
+          nfailed += 1
+    finally:
+      for t in threads:
+        jobs.put(None)
+      for t in threads:
+        t.join()
+      self.lock.release()
+    return (nsent, nfailed)
+
+
+# start_worker: starts the delivery in a background process.
+def start_worker():
+  import subprocess
+  script = os.path.abspath(__file__)
+  if script.endswith('.pyc') or script.endswith('.pyo'):
+    script = script[:-1]
+  devnull = file(os.devnull, 'r+')
+  subprocess.Popen([sys.executable, script, 'run'],
+                   stdin=devnull, stdout=devnull, stderr=devnull,
+                   close_fds=True, preexec_fn=os.setsid)
+  devnull.close()
+  return
+
+
+# main
+def main(argv):
+  import getopt
+  def usage():
+    print 'usage: %s [-n nworkers] {run|deliver}' % argv[0]
+    return 100
+  try:
+    (opts, args) = getopt.getopt(argv[1:], 'n:')
+  except getopt.GetoptError:
+    return usage()
+  nworkers = Outbox.NWORKERS
+  for (k, v) in opts:
+    if k == '-n': nworkers = int(v)
+  if not args: return usage()
+  outbox = Outbox(config.OUTBOX_DIR)
+  cmd = args[0]
+  if cmd == 'run':
+    # Background worker: returns if another one is running.
+    while 1:
+      try:
+        outbox.deliver(nworkers, wait=True, idle=config.OUTBOX_IDLE)
+      except Outbox.Busy:
+        break
+      # A message might have been queued before the lock was released.
+      if not outbox.get_pending(): break
+  elif cmd == 'deliver':
+    try:
+      (nsent, nfailed) = outbox.deliver(nworkers)
+    except Outbox.Busy, e:
+      print >>stderr, e
+      return 1
+    print '%d sent, %d failed.' % (nsent, nfailed)
+  else:
+    return usage()
+  return 0
+
+if __name__ == '__main__': sys.exit(main(sys.argv))
@@ -0,0 +1,546 @@
+#!/usr/bin/env python
+##
+##  popclient.py - POP3 client with UIDL and pipelining
+##
+##
+##  Usage:
+##
+##   # fetching the unseen messages of several mailboxes on one thread
+##   map = {}
+##   state = UIDState('pop3.uids')
+##   sessions = [ AsyncPOP3Session(host, 110, user, password, state, map=map)
+##                for (host,user,password) in accounts ]
+##   while not all( session.finished for session in sessions ):
+##     t0 = time.time()
+##     asyncore.loop(0.1, map=map, count=1)
+##     for session in sessions:
+##       session.check_timeout(time.time()-t0)
+##       for (uid,data) in session.get_messages():
+##         print data
+##         state.add(uid)
+##   state.save()
+##   for session in sessions:
+##     session.quit()
+##   while map:
+##     asyncore.loop(0.1, map=map, count=1)
+##
+
+import sys, os, os.path, poplib, socket, asynchat, ssl
+from collections import deque
+stderr = sys.stderr
+
+
+##  UIDState
+##
+##  The UIDs of the messages that have been fetched from a mailbox.
+##
+class UIDState:
+
+  def __init__(self, fname):
+    self.fname = fname
+    self.uids = None
+    return
+
+  def __repr__(self):
+    return '<UIDState: fname=%r, uids=%r>' % \
+           (self.fname, self.uids and len(self.uids))
+
+  def __contains__(self, uid):
+    self.load()
+    return uid in self.uids
+
+  def load(self):
+    if self.uids != None: return
+    self.uids = set()
+    if os.path.exists(self.fname):
+      fp = file(self.fname, 'rb')
+      for line in fp:
+        line = line.strip()
+        if line:
+          self.uids.add(line)
+      fp.close()
+    return
+
+  def add(self, uid):
+    self.load()
+    self.uids.add(uid)
+    return
+
+  def prune(self, uids):
+    # Forgets the UIDs that are no longer on the server.
+    self.load()
+    self.uids.intersection_update(uids)
+    return
+
+  def save(self):
+    self.load()
+    dirname = os.path.dirname(self.fname)
+    if dirname and not os.path.isdir(dirname):
+      os.makedirs(dirname)
+    tmpname = self.fname+'.new'
+    fp = file(tmpname, 'wb')
+    for uid in sorted(self.uids):
+      fp.write(uid+'\n')
+    fp.close()
+    os.rename(tmpname, self.fname)
+    return
+
+
+##  AsyncPOP3Session
+##
+##  A POP3 session driven by asyncore, so that several mailboxes
+##  can be fetched on one thread. It logs in, lists the mailbox
+##  with UIDL and retrieves the messages that are not in state.
+##  Received messages are taken by get_messages(); quit() deletes
+##  the listed messages (optionally) and ends the session.
+##  The session fails if nothing arrives from the server while the
+##  loop has waited for timeout seconds in total (check_timeout()
+##  is given the time of each wait).
+##
+class AsyncPOP3Session(asynchat.async_chat):
+
+  WINDOW = 32
+  TIMEOUT = 60
+
+  def __init__(self, hostname, port, username, password,
+               state=None, use_ssl=False, map=None, timeout=None):
+    asynchat.async_chat.__init__(self, map=map)
+    self.hostname = hostname
+    self.port = port
+    self.username = username
+    self.password = password
+    self.state = state
+    self.use_ssl = use_ssl
+    self.pipelining = False
+    self.handshaking = False
+    self.ready = False
+    self.finished = False
+    self.closed = False
+    self.error = None
+    self.uids = None
+    self.received = deque()
+    self._ibuf = []
+    self._resp = None
+    self._lines = None
+    self._unsent = deque()
+    self._sent = deque([ ('', self._greeting, False) ])
+    self._nretr = 0
+    self.timeout = timeout or self.TIMEOUT
+    self.idle = 0
+    self.set_terminator('\r\n')
+    self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.connect((hostname, port))
+    return
+
+  def __repr__(self):
+    return '<AsyncPOP3Session: hostname=%r, port=%r, username=%r, use_ssl=%r, uids=%r, finished=%r>' % \
+           (self.hostname, self.port, self.username, self.use_ssl,
+            self.uids and len(self.uids), self.finished)
+
+  def get_unseen(self):
+    if self.uids == None: return []
+    if not self.state: return self.uids
+    return [ (msgno,uid) for (msgno,uid) in self.uids
+             if uid == None or uid not in self.state ]
+
+  def get_messages(self):
+    # Returns [(uid, data), ...] that have arrived.
+    msgs = list(self.received)
+    self.received.clear()
+    return msgs
+
+  def quit(self, cleanup=False):
+    if self.closed: return
+    if cleanup and self.uids:
+      for (msgno,_) in self.uids:
+        self.command('DELE %d' % msgno, self._check)
+      self.uids = []
+    self.command('QUIT', self._quit)
+    return
+
+  def check_timeout(self, elapsed):
+    if self.closed: return
+    if not self._sent:
+      # Not waiting for the server.
+      self.idle = 0
+      return
+    self.idle += elapsed
+    if self.timeout < self.idle:
+      self.error = socket.timeout('timed out')
+      self.close()
+    return
+
+  # Commands.
+  def command(self, cmd, callback, multiline=False):
+    self._unsent.append((cmd, callback, multiline))
+    self._flush()
+    return
+
+  def _flush(self):
+    window = (self.pipelining and self.WINDOW) or 1
+    while self._unsent and len(self._sent) < window:
+      x = self._unsent.popleft()
+      self._sent.append(x)
+      self.push(x[0]+'\r\n')
+    return
+
+  def _check(self, resp, lines=None):
+    if not resp.startswith('+'):
+      raise poplib.error_proto(resp)
+    return
+
+  def _greeting(self, resp):
+    self._check(resp)
+    m = poplib.POP3.timestamp.match(resp)
+    if m:
+      import hashlib
+      digest = hashlib.md5(m.group(1)+self.password).hexdigest()
+      self.command('APOP %s %s' % (self.username, digest), self._login)
+    else:
+      self.command('USER %s' % self.username, self._check)
+      self.command('PASS %s' % self.password, self._login)
+    return
+
+  def _login(self, resp):
+    self._check(resp)
+    self.command('CAPA', self._capa, True)
+    return
+
+  def _capa(self, resp, lines):
+    if resp.startswith('+'):
+      self.pipelining = ('PIPELINING' in [ line.split(' ')[0].upper() for line in lines ])
+    self.command('UIDL', self._uidl, True)
+    return
+
+  def _uidl(self, resp, lines):
+    if resp.startswith('+'):
+      self.uids = []
+      for line in lines:
+        (msgno, uid) = line.split(' ', 1)
+        self.uids.append((int(msgno), uid.strip()))
+      self._retrieve()
+    else:
+      # UIDL is not supported: every message is fetched.
+      self.command('LIST', self._list, True)
+    return
+
+  def _list(self, resp, lines):
+    self._check(resp)
+    self.uids = [ (int(line.split(' ')[0]), None) for line in lines ]
+    self._retrieve()
+    return
+
+  def _retrieve(self):
+    self.ready = True
+    unseen = self.get_unseen()
+    self._nretr = len(unseen)
+    if not unseen:
+      self.finished = True
+    for (msgno,uid) in unseen:
+      self.command('RETR %d' % msgno,
+                   (lambda resp, lines, uid=uid: self._retr(uid, resp, lines)), True)
+    return
+
+  def _retr(self, uid, resp, lines):
+    self._check(resp)
+    self.received.append((uid, '\r\n'.join(lines)))
+    self._nretr -= 1
+    if not self._nretr:
+      self.finished = True
+    return
+
+  def _quit(self, resp):
+    self.close()
+    return
+
+  # Asynchronous I/O.
+  def handle_connect(self):
+    if self.use_ssl:
+      self.socket = ssl.wrap_socket(self.socket, do_handshake_on_connect=False)
+      self.handshaking = True
+      self._handshake()
+    return
+
+  def _handshake(self):
+    try:
+      self.socket.do_handshake()
+      self.handshaking = False
+    except ssl.SSLError, e:
+      if e.args[0] not in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE):
+        raise
+    return
+
+  def writable(self):
+    if self.handshaking: return False
+    return asynchat.async_chat.writable(self)
+
+  def handle_read(self):
+    self.idle = 0
+    if self.handshaking:
+      self._handshake()
+      return
+    asynchat.async_chat.handle_read(self)
+    # Data buffered by SSL is not noticed by select().
+    while self.use_ssl and self.connected and self.socket.pending():
+      asynchat.async_chat.handle_read(self)
+    return
+
+  def recv(self, n):
+    try:
+      return asynchat.async_chat.recv(self, n)
+    except ssl.SSLError, e:
+      if e.args[0] in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE):
+        return ''
+      raise
+
+  def send(self, data):
+    try:
+      return asynchat.async_chat.send(self, data)
+    except ssl.SSLError, e:
+      if e.args[0] in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE):
+        return 0
+      raise
+
+  def collect_incoming_data(self, data):
+    self._ibuf.append(data)
+    return
+
+  def found_terminator(self):
+    line = ''.join(self._ibuf)
+    self._ibuf = []
+    if self._lines != None:
+      # Inside a multi-line response.
+      if line != '.':
+        if line.startswith('..'):
+          line = line[1:]
+        self._lines.append(line)
+        return
+      (lines, self._lines) = (self._lines, None)
+      (_, callback, _) = self._sent.popleft()
+      callback(self._resp, lines)
+    elif not self._sent:
+      raise poplib.error_proto('unexpected response: %r' % line)
+    else:
+      (_, callback, multiline) = self._sent[0]
+      if multiline and line.startswith('+'):
+        self._resp = line
+        self._lines = []
+        return
+      self._sent.popleft()
+      if multiline:
+        callback(line, [])
+      else:
+        callback(line)
+    self._flush()
+    return
+
+  def handle_close(self):
+    if not self.closed and not self.error and self._sent:
+      self.error = poplib.error_proto('connection closed')
+    self.close()
+    return
+
+  def handle_error(self):
+    self.error = sys.exc_info()[1]
+    self.close()
+    return
+
+  def close(self):
+    self.closed = True
+    self.finished = True
+    asynchat.async_chat.close(self)
+    return
+
+
+if __name__ == '__main__':
+  import unittest, threading, SocketServer, asyncore, subprocess, time
+  statefile = './test.uids'
+  certfile = './test.pem'
+
+  # A stand-in POP3 server that serves MAILBOX.
+  MAILBOX = [ ('uid%d' % i, 'Subject: %d\r\n\r\nbody %d\r\n.dot\r\n' % (i,i))
+              for i in xrange(100) ]
+  class POP3Handler(SocketServer.StreamRequestHandler):
+    def handle(self):
+      deleted = set()
+      self.wfile.write('+OK ready\r\n')
+      for line in iter(self.rfile.readline, ''):
+        args = line.split()
+        cmd = args[0].upper()
+        if cmd == 'CAPA':
+          self.wfile.write('+OK\r\nUIDL\r\n%s.\r\n' % ''.join(self.server.capa))
+        elif cmd in ('USER', 'PASS'):
+          self.wfile.write('+OK\r\n')
+        elif cmd == 'LIST':
+          self.wfile.write('+OK\r\n')
+          for (i,(_,data)) in enumerate(self.server.mailbox):
+            self.wfile.write('%d %d\r\n' % (i+1, len(data)))
+          self.wfile.write('.\r\n')
+        elif cmd == 'UIDL':
+          self.wfile.write('+OK\r\n')
+          for (i,(uid,_)) in enumerate(self.server.mailbox):
+            self.wfile.write('%d %s\r\n' % (i+1, uid))
+          self.wfile.write('.\r\n')
+        elif cmd == 'RETR':
+          (_,data) = self.server.mailbox[int(args[1])-1]
+          data = data.replace('\r\n.', '\r\n..')
+          self.wfile.write('+OK\r\n%s.\r\n' % data)
+          self.server.nretr += 1
+        elif cmd == 'DELE':
+          deleted.add(int(args[1])-1)
+          self.wfile.write('+OK\r\n')
+        elif cmd == 'QUIT':
+          self.server.mailbox[:] = [ x for (i,x) in enumerate(self.server.mailbox)
+                                     if i not in deleted ]
+          self.wfile.write('+OK\r\n')
+          break
+        else:
+          self.wfile.write('-ERR unknown command\r\n')
+      return
+
+  def received(msgs):
+    return [ (uid, data[:-2]) for (uid,data) in msgs ]
+
+  class POP3SSLServer(SocketServer.TCPServer):
+    def get_request(self):
+      (sock, addr) = SocketServer.TCPServer.get_request(self)
+      return (ssl.wrap_socket(sock, server_side=True, certfile=certfile), addr)
+
+  class POP3ClientTest(unittest.TestCase):
+
+    def setUp(self):
+      self.servers = []
+      self.server = self.start_server()
+      return
+
+    def start_server(self, klass=SocketServer.TCPServer):
+      server = klass(('127.0.0.1', 0), POP3Handler)
+      server.mailbox = MAILBOX[:]
+      server.capa = ['PIPELINING\r\n']
+      server.nretr = 0
+      thread = threading.Thread(target=server.serve_forever)
+      thread.setDaemon(True)
+      thread.start()
+      self.servers.append(server)
+      return server
+
+    def run_sessions(self, sessions, cleanup=False):
+      # Runs the sessions on one loop until they finish.
+      map = sessions[0]._map
+      msgs = []
+      while not all( session.finished for session in sessions ):
+        asyncore.loop(0.1, map=map, count=1)
+        for session in sessions:
+          msgs.extend(session.get_messages())
+      for session in sessions:
+        self.assertEqual(session.error, None)
+        session.quit(cleanup)
+      while map:
+        asyncore.loop(0.1, map=map, count=1)
+      return msgs
+
+    def fetch(self):
+      state = UIDState(statefile)
+      session = AsyncPOP3Session(self.server.server_address[0], self.server.server_address[1],
+                                 'user', 'password', state, map={})
+      msgs = []
+      for (uid,data) in self.run_sessions([session]):
+        msgs.append(data)
+        state.add(uid)
+      state.prune( uid for (_,uid) in session.uids )
+      state.save()
+      return msgs
+
+    def test_incremental(self):
+      self.assertEqual(len(self.fetch()), 100)
+      self.assertEqual(self.fetch(), [])
+      self.server.mailbox.append(('uidnew', 'Subject: new\r\n\r\nnew\r\n'))
+      self.assertEqual(self.fetch(), ['Subject: new\r\n\r\nnew'])
+      self.assertEqual(self.server.nretr, 101)
+      # Forget the UIDs that were removed from the server.
+      del self.server.mailbox[:100]
+      self.fetch()
+      state = UIDState(statefile)
+      self.assertTrue('uidnew' in state)
+      self.assertEqual(len(state.uids), 1)
+      return
+
+    def test_async(self):
+      server2 = self.start_server()
+      server2.capa = []
+      map = {}
+      state = UIDState(statefile)
+      for uid in ('uid0', 'uid1'):
+        state.add(uid)
+      sessions = [ AsyncPOP3Session(host, port, 'user', 'password', state, map=map)
+                   for (host,port) in (self.server.server_address, server2.server_address) ]
+      msgs = self.run_sessions(sessions, cleanup=True)
+      self.assertEqual(len(msgs), 196)
+      self.assertEqual(sorted(msgs), sorted(received(MAILBOX[2:])*2))
+      self.assertTrue(sessions[0].pipelining)
+      self.assertFalse(sessions[1].pipelining)
+      self.assertEqual(self.server.mailbox, [])
+      self.assertEqual(server2.mailbox, [])
+      return
+
+    def test_async_error(self):
+      map = {}
+      (host, port) = self.server.server_address
+      # Empty mailbox.
+      del self.server.mailbox[:]
+      session = AsyncPOP3Session(host, port, 'user', 'password', map=map)
+      while not session.finished:
+        asyncore.loop(0.1, map=map, count=1)
+      self.assertEqual(session.error, None)
+      self.assertEqual(session.get_messages(), [])
+      session.quit()
+      # Connection refused.
+      self.server.server_close()
+      session = AsyncPOP3Session(host, port, 'user', 'password', map=map)
+      while not session.finished:
+        asyncore.loop(0.1, map=map, count=1)
+      self.assertNotEqual(session.error, None)
+      return
+
+    def test_async_timeout(self):
+      # A server that accepts the connection but never responds.
+      sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+      sock.bind(('127.0.0.1', 0))
+      sock.listen(1)
+      (host, port) = sock.getsockname()
+      map = {}
+      session = AsyncPOP3Session(host, port, 'user', 'password', map=map, timeout=0.5)
+      while not session.finished:
+        t0 = time.time()
+        asyncore.loop(0.1, map=map, count=1)
+        session.check_timeout(time.time()-t0)
+      self.assertTrue(isinstance(session.error, socket.timeout))
+      self.assertEqual(map, {})
+      sock.close()
+      return
+
+    def test_async_ssl(self):
+      try:
+        subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048',
+                               '-nodes', '-days', '1', '-subj', '/CN=localhost',
+                               '-keyout', certfile, '-out', certfile],
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+      except OSError:
+        return
+      server = self.start_server(POP3SSLServer)
+      (host, port) = server.server_address
+      session = AsyncPOP3Session(host, port, 'user', 'password', use_ssl=True, map={})
+      msgs = self.run_sessions([session])
+      self.assertEqual(msgs, received(MAILBOX))
+      return
+
+    def tearDown(self):
+      for server in self.servers:
+        server.shutdown()
+        server.server_close()
+      for fname in (statefile, certfile):
+        if os.path.exists(fname):
+          os.unlink(fname)
+      return
+
+  unittest.main()
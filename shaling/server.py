@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+##
+##  server.py - kernel server
+##
+##  A long-lived process that keeps a Kernel (and its corpora and
+##  selections) and runs the commands sent by shell clients through
+##  a Unix socket. The output is streamed back to the client.
+##
+##
+##  Usage:
+##
+##   $ python server.py start &
+##   $ shaling scan     # runs on the server if it is running.
+##   $ python server.py stop
+##
+##  Protocol: the client sends a pickled (cmd, args, env) and the
+##  server replies with pickled (kind, value) frames until 'done'.
+##  The command is run in the current directory of the client
+##  (env['cwd']) so that relative paths mean the same files.
+##  Some frames ('prompt', 'save', 'load', 'endpager') are answered
+##  by the client with (status, value).
+##
+
+import sys, os, os.path, socket
+try:
+  import cPickle as pickle
+except ImportError:
+  import pickle
+import config
+from interface import Interface, ColorTerminalInterface
+stderr = sys.stderr
+
+# Commands that need the local terminal (an editor, a viewer or
+# the current directory) are always run by the client.
+LOCAL_COMMANDS = set(['comp', 'edit', 'mime', 'get'])
+
+def is_remote(cmd, args):
+  if cmd in LOCAL_COMMANDS: return False
+  if cmd == 'show' and '-a' in args: return False
+  return True
+
+def get_rcfile():
+  return os.path.join(os.environ['HOME'], '.shalingrc')
+
+
+##  RemoteTerminalInterface
+##
+##  A terminal whose output goes to a client.
+##
+class RemoteTerminalInterface(ColorTerminalInterface):
+
+  def __init__(self, rfile, wfile, env):
+    ColorTerminalInterface.__init__(self, wfile, config.TERMINAL_CHARSET)
+    self.rfile = rfile
+    self.wfile = wfile
+    self.interactive = env.get('interactive', False)
+    self.lines = env.get('lines', 0)
+    self.cols = env.get('cols', 0)
+    return
+
+  def send(self, kind, value=None):
+    if kind != 'out':
+      # The buffered output goes first.
+      self.flush_output()
+    pickle.dump((kind, value), self.wfile, 2)
+    return
+
+  def ask(self, kind, value=None):
+    self.send(kind, value)
+    self.wfile.flush()
+    (status, value) = pickle.load(self.rfile)
+    if status == 'cancel':
+      raise Interface.Cancelled(value)
+    if status == 'error':
+      raise Interface.Aborted(value)
+    return value
+
+  def color(self, color, s):
+    if not self.interactive:
+      return self.to_terminal(s)
+    return ColorTerminalInterface.color(self, color, s)
+
+  def write(self, data):
+    self.send('out', data)
+    return
+
+  def flush(self):
+    self.flush_output()
+    self.wfile.flush()
+    return
+
+  def show_binary(self, data, mimetype):
+    raise Interface.Aborted('Cannot display on the server: %s' % mimetype)
+
+  def prompt(self, question):
+    if not self.interactive:
+      return Interface.prompt(self, question)
+    return self.ask('prompt', question)
+
+  def save_file(self, data, filename, confirm=False):
+    return self.ask('save', (data, filename, confirm))
+
+  def save_stream(self, chunks, filename, confirm=False):
+    try:
+      data = ''.join(chunks)
+    except ValueError, e:
+      raise Interface.Aborted(e)
+    return self.save_file(data, filename, confirm)
+
+  def load_file(self, filename):
+    return self.ask('load', filename)
+
+  def open_pager(self):
+    if self.interactive:
+      self.send('pager')
+    return self
+
+  def wait_finish(self):
+    if not self.interactive:
+      return Interface.wait_finish(self)
+    self.ask('endpager')
+    return
+
+
+##  KernelServer
+##
+class KernelServer:
+
+  def __init__(self, sockname):
+    self.sockname = sockname
+    self.kernel = None
+    self.signature = None
+    self.rcstamp = os.stat(get_rcfile()).st_mtime
+    return
+
+  def __repr__(self):
+    return '<KernelServer: sockname=%r, kernel=%r>' % (self.sockname, self.kernel)
+
+  def get_signature(self):
+    # Files that are changed by other processes.
+    sig = []
+    dirnames = [ config.SELECTION_DIR ]
+    if self.kernel:
+      for dirname in self.kernel.corpus.iterkeys():
+        dirnames.extend([ dirname ]+[ os.path.join(dirname, x) for x in ('tar', 'label', 'idx') ])
+    for dirname in dirnames:
+      try:
+        names = os.listdir(dirname)
+      except OSError:
+        continue
+      for name in sorted(names):
+        try:
+          st = os.stat(os.path.join(dirname, name))
+        except OSError:
+          continue
+        sig.append((dirname, name, st.st_mtime, st.st_size))
+    return sig
+
+  def run(self):
+    from utils import log
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    if os.path.exists(self.sockname):
+      os.unlink(self.sockname)
+    # Nobody else can connect even before chmod.
+    umask = os.umask(0077)
+    try:
+      sock.bind(self.sockname)
+    finally:
+      os.umask(umask)
+    os.chmod(self.sockname, 0600)
+    sock.listen(5)
+    log('server: started: %r' % self.sockname)
+    try:
+      while 1:
+        (conn, _) = sock.accept()
+        try:
+          if not self.handle(conn): break
+        except (socket.error, IOError, EOFError), e:
+          log('server: %r' % e)
+        finally:
+          conn.close()
+    finally:
+      sock.close()
+      os.unlink(self.sockname)
+      if self.kernel:
+        self.kernel.close()
+      log('server: stopped: %r' % self.sockname)
+    return
+
+  # discard_kernel: closes the current kernel so that its files are
+  # not left open. Its selection is not saved again, as another
+  # process may have saved a newer one.
+  def discard_kernel(self):
+    from utils import log
+    kernel = self.kernel
+    self.kernel = None
+    if kernel == None: return
+    kernel.current_selection = None
+    try:
+      kernel.close()
+    except Exception, e:
+      log('server: cannot close the kernel: %r' % e)
+    return
+
+  def handle(self, conn):
+    rfile = conn.makefile('rb')
+    wfile = conn.makefile('wb')
+    (cmd, args, env) = pickle.load(rfile)
+    if cmd == None:
+      # stop
+      pickle.dump(('done', None), wfile, 2)
+      wfile.flush()
+      return False
+    if os.stat(get_rcfile()).st_mtime != self.rcstamp:
+      # The configuration is changed: the client runs the command.
+      pickle.dump(('stale', None), wfile, 2)
+      wfile.flush()
+      return False
+    cwd = os.getcwd()
+    try:
+      os.chdir(env['cwd'])
+    except (KeyError, OSError):
+      # The client runs the command.
+      pickle.dump(('stale', None), wfile, 2)
+      wfile.flush()
+      return True
+    try:
+      self.execute(rfile, wfile, cmd, args, env)
+    finally:
+      os.chdir(cwd)
+    return True
+
+  def execute(self, rfile, wfile, cmd, args, env):
+    import traceback
+    from kernel import Kernel
+    from shell import ShalingShell
+    terminal = RemoteTerminalInterface(rfile, wfile, env)
+    if self.kernel == None or self.get_signature() != self.signature:
+      # The database is changed by someone else.
+      self.discard_kernel()
+      self.kernel = Kernel(terminal)
+    self.kernel.terminal = terminal
+    try:
+      try:
+        ShalingShell(terminal, self.kernel).execute(cmd, args)
+      finally:
+        self.kernel.release()
+        self.signature = self.get_signature()
+    except (socket.error, IOError):
+      raise
+    except Exception:
+      terminal.send('error', traceback.format_exc())
+      self.discard_kernel()
+    terminal.send('done')
+    wfile.flush()
+    return
+
+
+# call: runs a command on the server.
+# Returns False if the server is not available.
+def call(sockname, cmd, args, terminal):
+  from interface import InteractiveTerminalInterface
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    sock.connect(sockname)
+  except socket.error:
+    return False
+  rfile = sock.makefile('rb')
+  wfile = sock.makefile('wb')
+  def reply(status, value=None):
+    pickle.dump((status, value), wfile, 2)
+    wfile.flush()
+    return
+  env = { 'interactive': isinstance(terminal, InteractiveTerminalInterface),
+          'lines': terminal.lines, 'cols': terminal.cols,
+          'cwd': os.getcwd() }
+  pickle.dump((cmd, args, env), wfile, 2)
+  wfile.flush()
+  pager = None
+  try:
+    while 1:
+      (kind, value) = pickle.load(rfile)
+      if kind == 'out':
+        try:
+          (pager or terminal).display(value)
+        except Interface.PagerClosed:
+          # The rest of the output to the pager is discarded.
+          pass
+      elif kind == 'done':
+        break
+      elif kind == 'stale':
+        return False
+      elif kind == 'error':
+        terminal.flush()
+        print >>stderr, value
+      elif kind == 'pager':
+        pager = terminal.open_pager()
+      elif kind == 'endpager':
+        pager.wait_finish()
+        pager = None
+        reply('ok')
+      elif kind in ('prompt', 'save', 'load'):
+        try:
+          if kind == 'prompt':
+            reply('ok', terminal.prompt(value))
+          elif kind == 'save':
+            (data, filename, confirm) = value
+            reply('ok', terminal.save_file(data, filename, confirm))
+          else:
+            reply('ok', terminal.load_file(value))
+        except Interface.Cancelled, e:
+          reply('cancel', str(e))
+        except Interface.InterfaceError, e:
+          reply('error', str(e))
+  finally:
+    sock.close()
+  terminal.flush()
+  return True
+
+
+# main
+def main(argv):
+  import getopt
+  def usage():
+    print 'usage: %s [-s sockname] {start|stop}' % argv[0]
+    return 100
+  try:
+    (opts, args) = getopt.getopt(argv[1:], 's:')
+  except getopt.GetoptError:
+    return usage()
+  sockname = config.SERVER_SOCKET
+  for (k, v) in opts:
+    if k == '-s': sockname = v
+  if not args: return usage()
+  cmd = args[0]
+  if cmd == 'start':
+    KernelServer(sockname).run()
+  elif cmd == 'stop':
+    from interface import DumbTerminalInterface
+    if not call(sockname, None, [], DumbTerminalInterface(sys.stdout, config.TERMINAL_CHARSET)):
+      print >>stderr, 'Server is not running: %r' % sockname
+      return 1
+  else:
+    return usage()
+  return 0
+
+if __name__ == '__main__': sys.exit(main(sys.argv))
@@ -86,6 +86,16 @@ class ShellLexer:
     return (self.parse_arg, endpos+1)
 
 
+# expand_alias: returns (cmd, args) with COMMAND_ALIASES expanded.
+def expand_alias(cmd, args):
+  from config import COMMAND_ALIASES
+  if cmd in COMMAND_ALIASES:
+    ext = COMMAND_ALIASES[cmd].split(' ')
+    cmd = ext[0]
+    args[0:0] = ext[1:]
+  return (cmd, args)
+
+
 ##  ShalingShell
 ##
 class ShalingShell(cmd.Cmd):
@@ -100,16 +110,12 @@ class ShalingShell(cmd.Cmd):
     return
 
   def execute(self, cmd, args):
-    from config import COMMAND_ALIASES
     from kernel import Kernel
     from interface import Interface
     from maildb import MailCorpus
     from utils import log
     log('execute: %s %r' % (cmd, args))
-    if cmd in COMMAND_ALIASES:
-      ext = COMMAND_ALIASES[cmd].split(' ')
-      cmd = ext[0]
-      args[0:0] = ext[1:]
+    (cmd, args) = expand_alias(cmd, args)
     try:
       f = 'cmd_'+cmd
       if hasattr(self.kernel, f):
@@ -126,6 +132,7 @@ class ShalingShell(cmd.Cmd):
       self.terminal.warning('Database error: %s' % e)
     except KeyboardInterrupt, e:
       self.terminal.warning('Interrupted.')
+    self.terminal.flush()
     return
 
   def do_exit(self, _):
@@ -142,17 +149,96 @@ class ShalingShell(cmd.Cmd):
     return
 
 
+##  StartupProfile
+##
+##  Records the time to import each module and the time until
+##  the first output. (shaling --startup-profile cmd args ...)
+##
+class StartupProfile:
+
+  def __init__(self, outfp):
+    import time, __builtin__
+    self.outfp = outfp
+    self.clock = time.time
+    self.t0 = self.clock()
+    self.t1 = None
+    self.depth = 0
+    self.imports = []
+    self._import = __builtin__.__import__
+    __builtin__.__import__ = self.hook
+    return
+
+  def __repr__(self):
+    return '<StartupProfile: imports=%d>' % len(self.imports)
+
+  def hook(self, name, *args, **kwargs):
+    if name in sys.modules:
+      return self._import(name, *args, **kwargs)
+    i = len(self.imports)
+    self.imports.append((self.depth, name, None))
+    self.depth += 1
+    t = self.clock()
+    try:
+      return self._import(name, *args, **kwargs)
+    finally:
+      self.depth -= 1
+      self.imports[i] = (self.depth, name, self.clock()-t)
+
+  # Behaves as the output file.
+  def write(self, s):
+    if self.t1 == None:
+      self.t1 = self.clock()
+    self.outfp.write(s)
+    return
+
+  def __getattr__(self, name):
+    return getattr(self.outfp, name)
+
+  def report(self, fp):
+    import __builtin__
+    __builtin__.__import__ = self._import
+    t = self.clock()
+    for (depth, name, dt) in self.imports:
+      if dt == None: continue
+      print >>fp, '%8.1fms %s%s' % (dt*1000, '  '*depth, name)
+    if self.t1 != None:
+      print >>fp, '%8.1fms (first output)' % ((self.t1-self.t0)*1000)
+    print >>fp, '%8.1fms (total)' % ((t-self.t0)*1000)
+    return
+
+
 # main
 def main(argv):
+  profile = None
+  if argv[1:2] == ['--startup-profile']:
+    profile = StartupProfile(sys.stdout)
+    argv = argv[:1]+argv[2:]
+  try:
+    run(argv, profile or sys.stdout)
+  finally:
+    if profile:
+      sys.stdout.flush()
+      profile.report(sys.stderr)
+  return
+
+# run: runs a command (or the shell) with output to outfp.
+def run(argv, outfp):
   import os
   import config
   from interface import InteractiveTerminalInterface, DumbTerminalInterface
-  from kernel import Kernel
   try:
     os.ttyname(1)
-    terminal = InteractiveTerminalInterface(sys.stdout, config.TERMINAL_CHARSET)
+    terminal = InteractiveTerminalInterface(outfp, config.TERMINAL_CHARSET)
   except OSError:
-    terminal = DumbTerminalInterface(sys.stdout, config.TERMINAL_CHARSET)
+    terminal = DumbTerminalInterface(outfp, config.TERMINAL_CHARSET)
+  if 2 <= len(argv) and config.USE_KERNEL_SERVER and \
+     config.SERVER_SOCKET and os.path.exists(config.SERVER_SOCKET):
+    # Run the command on the kernel server if possible.
+    import server
+    (cmd, args) = expand_alias(argv[1], [ terminal.from_terminal(x) for x in argv[2:] ])
+    if server.is_remote(cmd, args) and server.call(config.SERVER_SOCKET, cmd, args, terminal):
+      return
+  from kernel import Kernel
   kernel = Kernel(terminal)
   try:
     shell = ShalingShell(terminal, kernel)
@@ -163,6 +249,7 @@ def main(argv):
       shell.execute(cmd, [ terminal.from_terminal(x) for x in args ])
   finally:
     kernel.close()
+    terminal.flush()
   return
 
 if __name__ == '__main__': sys.exit(main(sys.argv))
@@ -206,6 +206,35 @@ class Catalog:
     return
 
 
+##  RecordFile
+##
+##  A read-only file object for the data of a record.
+##  (The tar file can be shared with others.)
+##
+class RecordFile:
+
+  def __init__(self, fp, offset, size):
+    self.fp = fp
+    self.offset = offset
+    self.size = size
+    self.pos = 0
+    return
+
+  def __repr__(self):
+    return '<RecordFile: fp=%r, offset=%d, size=%d>' % (self.fp, self.offset, self.size)
+
+  def read(self, n=-1):
+    if n < 0 or self.size < self.pos+n:
+      n = self.size-self.pos
+    if n <= 0: return ''
+    self.fp.seek(self.offset+self.pos)
+    data = self.fp.read(n)
+    if len(data) != n:
+      raise TarDB.Corrupted('RecordFile: premature eof: %r' % self)
+    self.pos += n
+    return data
+
+
 ##  TarDB
 ##
 class TarDB:
@@ -352,7 +381,35 @@ class TarDB:
       yield self.get_info(recno)
     return
   
-  def get_record(self, recno):
+  def get_segments(self):
+    '''
+    Returns [(name, nrecords, datasize, filesize), ...] for each tar
+    file, reading only the catalog and the tar headers.
+    '''
+    if not self.mode:
+      raise TarDB.FileError('get_segments: not opened: %r' % self)
+    segments = {}
+    for recno in xrange(len(self._catalog)):
+      (name, _) = self._catalog.get(recno)
+      info = self.get_info(recno)
+      if name not in segments:
+        segments[name] = [0, 0]
+      segments[name][0] += 1
+      segments[name][1] += info.size
+    r = []
+    for name in sorted(segments.iterkeys()):
+      (nrecords, datasize) = segments[name]
+      filesize = os.path.getsize(os.path.join(self.basedir, name)+'.tar')
+      r.append((name, nrecords, datasize, filesize))
+    return r
+
+  def get_segment_files(self):
+    if not self.mode:
+      raise TarDB.FileError('get_segment_files: not opened: %r' % self)
+    names = set( name for (name,_) in self._catalog )
+    return [ os.path.join(self.basedir, name)+'.tar' for name in sorted(names) ]
+
+  def _get_record_info(self, recno):
     if not self.mode:
       raise TarDB.FileError('get_record: not opened: %r' % self)
     try:
@@ -368,11 +425,21 @@ class TarDB:
       info = TarInfo.frombuf(buf)
     except ValueError:
       raise TarDB.Corrupted('get_record: tar record corrupted: %r, recno=%d, offset=%d' % (self, recno, offset))
+    return (info, tarfp, offset+BLOCKSIZE)
+
+  def get_record(self, recno):
+    (info, tarfp, _) = self._get_record_info(recno)
     data = tarfp.read(info.size)
     if len(data) != info.size:
-      raise TarDB.Corrupted('get_record: premature eof in data block: %r, recno=%d, info_offset=%d' % (self, recno, offset))
+      raise TarDB.Corrupted('get_record: premature eof in data block: %r, recno=%d' % (self, recno))
     return (info, data)
 
+  # get_record_file: returns (info, fp) where fp reads the data
+  # of the record without loading it at once.
+  def get_record_file(self, recno):
+    (info, tarfp, offset) = self._get_record_info(recno)
+    return (info, RecordFile(tarfp, offset, info.size))
+
   def add_record(self, info, data):
     if not self.mode:
       raise TarDB.FileError('add_record: not opened: %r' % self)
@@ -436,6 +503,13 @@ if __name__ == '__main__':
       self.assertEqual(len(infos), 2)
       self.assertEqual(infos[0].name, info1.name)
       self.assertEqual(infos[1].name, info2.name)
+      # record file
+      (info2, fp) = db.get_record_file(1)
+      self.assertEqual(info2.name, 'bar')
+      self.assertEqual(fp.read(4), 'ABCD')
+      db.get_record(0)
+      self.assertEqual(fp.read(), 'EF')
+      self.assertEqual(fp.read(), '')
       db.close()
       return
     
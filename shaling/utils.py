@@ -4,7 +4,8 @@ import config
 from email import Utils, Header, Charset
 stderr = sys.stderr
 
-# ms932 hack
+# ms932 hack: registered here so that every path that decodes headers
+# (indexing and scanning as well as show and compose) sees it.
 Charset.add_codec('shift_jis', 'ms932')
 
 
@@ -21,6 +22,45 @@ NUM_PAT = re.compile(r'\d+')
 def get_numbers(x):
   return [ int(m.group(0)) for m in NUM_PAT.finditer(x) ]
 
+# parse_date_spec: 'YYYY', 'YYYY-MM', 'YYYY-MM-DD' or 'Nd' (N days ago).
+# If end is True, returns the end of the period instead of the beginning.
+DATE_SPEC_PAT = re.compile(r'^(\d{4})(?:[-/](\d{1,2})(?:[-/](\d{1,2}))?)?$')
+DAYS_SPEC_PAT = re.compile(r'^(\d+)d$')
+def parse_date_spec(s, end=False):
+  m = DAYS_SPEC_PAT.match(s)
+  if m:
+    v = list(time.localtime(time.time()-int(m.group(1))*86400)[:3])
+  else:
+    m = DATE_SPEC_PAT.match(s)
+    if not m:
+      raise ValueError('Invalid date: %r' % s)
+    v = [ int(x) for x in m.groups() if x ]
+    if 2 <= len(v) and not (1 <= v[1] <= 12):
+      raise ValueError('Invalid date: %r' % s)
+    if 3 <= len(v):
+      import calendar
+      if not (1 <= v[2] <= calendar.monthrange(v[0], v[1])[1]):
+        raise ValueError('Invalid date: %r' % s)
+  # (The end of a period can overflow, which mktime() normalizes.)
+  if end:
+    v[-1] += 1
+  v += [1]*(3-len(v))
+  return int(time.mktime((v[0], v[1], v[2], 0, 0, 0, 0, 0, -1)))
+
+# parse_size_spec: '>1M', '<100k' or '2048' (= larger than).
+# Returns (smin, smax).
+SIZE_SPEC_PAT = re.compile(r'^([<>])?(\d+)([kmg])?$', re.I)
+SIZE_UNITS = { 'k': 1024, 'm': 1024*1024, 'g': 1024*1024*1024 }
+def parse_size_spec(s):
+  m = SIZE_SPEC_PAT.match(s)
+  if not m:
+    raise ValueError('Invalid size: %r' % s)
+  (op, n, unit) = m.groups()
+  n = int(n) * SIZE_UNITS.get((unit or '').lower(), 1)
+  if op == '<':
+    return (None, n)
+  return (n, None)
+
 # rmsp
 RMSP_PAT = re.compile(r'\s+', re.UNICODE)
 def rmsp(x):
@@ -47,11 +87,8 @@ class MessageFormatError(MessageError): pass
 
 # get_message_part (base:1)
 def get_message_part(msg, n):
-  i = 0
-  for m1 in msg.walk():
-    if m1.is_multipart(): continue
-    i += 1
-    if n == i: return m1
+  for (i,_,_,_,_,_,_,mpart) in get_part_index(msg):
+    if n == i: return mpart
   raise MessagePartNotFoundError(msg, n)
 
 # get_message_date
@@ -61,22 +98,204 @@ def get_message_date(msg):
   except:
     return 0
 
-# returns [(mpart, level, idx), ...]
+# get_mime_summary: returns ([mimetype, ...], nattachments)
+# by scanning the raw message without parsing it. Only the
+# header blocks of the message and its parts are looked at.
+# data can be a str or a buffer (only regexps and slices are used).
+CONTENT_TYPE_PAT = re.compile(r'^content-type:[ \t]*([-\w.+]+/[-\w.+]+)', re.I | re.M)
+ATTACHMENT_PAT = re.compile(r'^content-disposition:[ \t]*attachment', re.I | re.M)
+BOUNDARY_PAT = re.compile(r'boundary[ \t]*=[ \t]*(?:"([^"\r\n]+)"|([^\s;"]+))', re.I)
+BLANK_LINE_PAT = re.compile(r'\r?\n\r?\n')
+EOL_PAT = re.compile(r'\r?\n')
+def get_mime_summary(data):
+  (types, nattach) = (set(), 0)
+  # The offsets of the header blocks to look at.
+  starts = [0]
+  while starts:
+    start = starts.pop()
+    m = BLANK_LINE_PAT.search(data, start)
+    if EOL_PAT.match(data, start):
+      # No headers.
+      (header, end) = ('', start)
+    elif m:
+      (header, end) = (data[start:m.start()], m.end())
+    else:
+      (header, end) = (data[start:], len(data))
+    m = CONTENT_TYPE_PAT.search(header)
+    ctype = (m and m.group(1).lower()) or 'text/plain'
+    if ATTACHMENT_PAT.search(header):
+      nattach += 1
+    if ctype == 'message/rfc822':
+      starts.append(end)
+    elif ctype.startswith('multipart/'):
+      m = BOUNDARY_PAT.search(header)
+      if m:
+        boundary = m.group(1) or m.group(2)
+        pat = re.compile(r'^--'+re.escape(boundary)+r'(--)?[ \t]*\r?$', re.M)
+        for m in pat.finditer(data, end):
+          if m.group(1): break
+          starts.append(m.end()+1)
+    else:
+      types.add(ctype)
+  return (sorted(types) or ['text/plain'], nattach)
+
+# get_message_digest: returns an md5 digest of the Message-ID
+# and the body of the raw message. Identical messages that are
+# imported twice get the same digest. Returns None for a message
+# without a Message-ID (the body alone is not enough).
+MESSAGE_ID_PAT = re.compile(r'^message-id:\s*(\S+)', re.I | re.M)
+HEADER_END_PAT = re.compile(r'\r?\n\r?\n')
+def get_message_digest(data):
+  import hashlib
+  m = HEADER_END_PAT.search(data)
+  if m:
+    (header, body) = (data[:m.start()], data[m.end():])
+  else:
+    (header, body) = (data, '')
+  m = MESSAGE_ID_PAT.search(header)
+  if not m: return None
+  h = hashlib.md5(m.group(1))
+  h.update('\x00')
+  h.update(body.rstrip())
+  return h.digest()
+
+##  Part index
+##
+##  A flat list of the MIME parts of a message in the order of
+##  msg.walk(): [(n, path, level, content_type, charset, filename,
+##  span, mpart), ...]. n is the part number (base:1) of a leaf and
+##  None for a multipart. path is the tuple of the child positions
+##  from the root. span is the (start, end) of the part in the raw
+##  message (or None) and mpart is the Message object (or None).
+##
+
+# get_part_index: returns the part index of a parsed message.
+# It is made once and kept in the message until it is changed
+# (see invalidate_part_index).
+def get_part_index(msg):
+  try:
+    return msg._part_index
+  except AttributeError:
+    pass
+  index = []
+  leaves = []
+  def walk1(mpart, path):
+    if mpart.is_multipart():
+      index.append((None, path, len(path), mpart.get_content_type(),
+                    mpart.get_content_charset(), mpart.get_filename(), None, mpart))
+      for (i,m) in enumerate(mpart.get_payload()):
+        walk1(m, path+(i,))
+    else:
+      leaves.append(mpart)
+      index.append((len(leaves), path, len(path), mpart.get_content_type(),
+                    mpart.get_content_charset(), mpart.get_filename(), None, mpart))
+    return
+  walk1(msg, ())
+  msg._part_index = index
+  return index
+
+def invalidate_part_index(msg):
+  msg.__dict__.pop('_part_index', None)
+  return
+
+# scan_message_parts: makes a part index of a raw message
+# by reading only the headers of each part and the boundaries.
+# Returns None if the message is not simple enough for this
+# (message/* parts or broken multiparts).
+def scan_message_parts(data):
+  from email.Parser import HeaderParser
+  parser = HeaderParser()
+  index = []
+  leaves = []
+  class Unscannable(Exception): pass
+
+  def scan1(path, start, end, default_type):
+    # Split the headers and the body.
+    if data.startswith('\n', start):
+      (hend, bstart) = (start, start+1)
+    elif data.startswith('\r\n', start):
+      (hend, bstart) = (start, start+2)
+    else:
+      m = HEADER_END_PAT.search(data, start, end)
+      if m:
+        (hend, bstart) = (m.start(), m.end())
+      else:
+        (hend, bstart) = (end, end)
+    headers = parser.parsestr(data[start:hend])
+    headers.set_default_type(default_type)
+    ctype = headers.get_content_type()
+    entry = (path, len(path), ctype, headers.get_content_charset(),
+             headers.get_filename(), (start, end), None)
+    if headers.get_content_maintype() == 'message':
+      raise Unscannable(ctype)
+    if headers.get_content_maintype() != 'multipart':
+      leaves.append(path)
+      index.append((len(leaves),)+entry)
+      return
+    boundary = headers.get_boundary()
+    if not boundary:
+      raise Unscannable(ctype)
+    index.append((None,)+entry)
+    if ctype == 'multipart/digest':
+      default_type = 'message/rfc822'
+    else:
+      default_type = 'text/plain'
+    pat = re.compile(r'^--'+re.escape(boundary)+r'(--)?[ \t]*(?:\r\n|\r|\n|$)', re.M)
+    (i, pstart) = (0, None)
+    for m in pat.finditer(data, bstart, end):
+      if pstart != None:
+        # The line break before a boundary belongs to the boundary.
+        pend = m.start()
+        if data.startswith('\r\n', pend-2):
+          pend -= 2
+        elif data.startswith('\n', pend-1) or data.startswith('\r', pend-1):
+          pend -= 1
+        scan1(path+(i,), pstart, max(pstart, pend), default_type)
+        i += 1
+      if m.group(1): break
+      pstart = m.end()
+    else:
+      if pstart == None:
+        raise Unscannable(ctype)
+      scan1(path+(i,), pstart, end, default_type)
+      i += 1
+    if i == 0:
+      raise Unscannable(ctype)
+    return
+
+  try:
+    scan1((), 0, len(data), 'text/plain')
+  except Unscannable:
+    return None
+  return index
+
+# extract_message_part: parses only the n-th part (base:1)
+# of a raw message with its index (see scan_message_parts).
+def extract_message_part(data, index, n):
+  from email import message_from_string
+  for (i,_,_,_,_,_,(start,end),_) in index:
+    if n == i: return message_from_string(data[start:end])
+  raise MessagePartNotFoundError(n)
+
+# returns [(idx, mpart, level), ...]
+# (idx is the part number (base:0) and None for a multipart.)
 def enum_message_parts(msg, favor=None):
+  index = get_part_index(msg)
+  skipped = set()
+  if favor:
+    # Choose the favorite parts of multipart/alternative.
+    for (_,path,_,ctype,_,_,_,_) in index:
+      if ctype != 'multipart/alternative': continue
+      children = [ (p,t) for (_,p,_,t,_,_,_,_) in index if p[:-1] == path ]
+      if favor in [ t for (_,t) in children ]:
+        skipped.update( p for (p,t) in children if t != favor )
   r = []
-  def walk1(i, mpart, level):
-    if mpart.is_multipart():
+  for (n,path,level,_,_,_,_,mpart) in index:
+    if [ 1 for i in xrange(len(path)) if path[:i+1] in skipped ]: continue
+    if n == None:
       r.append( (None, mpart, level) )
-      children = mpart.get_payload()
-      if mpart.get_content_subtype() == 'alternative' and favor:
-        children = [ m for m in children if m.get_content_type() == favor ] or children
-      for m in children:
-        i = walk1(i, m, level+1)
     else:
-      r.append( (i, mpart, level) )
-      i += 1
-    return i
-  walk1(0, msg, 0)
+      r.append( (n-1, mpart, level) )
   return r
 
 # validate_message_structure
@@ -118,16 +337,75 @@ def msg_repr(msg):
   Generator.Generator(fp, mangle_from_=False).flatten(msg)
   return fp.getvalue()
 
-make_msgid = Utils.make_msgid
-formataddr = Utils.formataddr
-formatdate = Utils.formatdate
+def make_msgid(idstring=None):
+  return Utils.make_msgid(idstring)
+def formataddr(pair):
+  return Utils.formataddr(pair)
+def formatdate(*args, **kwargs):
+  return Utils.formatdate(*args, **kwargs)
 
 ##  Header utilities
 ##
 
+##  LRUCache
+##
+##  Keeps the values of the most recently used keys.
+##  (This is shared by threads.)
+##
+class LRUCache:
+
+  def __init__(self, size):
+    from collections import OrderedDict
+    from thread import allocate_lock
+    self.size = size
+    self.hits = 0
+    self.misses = 0
+    self._items = OrderedDict()
+    self._lock = allocate_lock()
+    return
+
+  def __repr__(self):
+    return ('<LRUCache: size=%d, items=%d, hits=%d, misses=%d>' %
+            (self.size, len(self._items), self.hits, self.misses))
+
+  def __len__(self):
+    return len(self._items)
+
+  def get(self, key, func):
+    # Returns the cached value of key or func(key).
+    self._lock.acquire()
+    try:
+      try:
+        value = self._items.pop(key)
+        self._items[key] = value
+        self.hits += 1
+        return value
+      except KeyError:
+        self.misses += 1
+    finally:
+      self._lock.release()
+    value = func(key)
+    self._lock.acquire()
+    try:
+      self._items[key] = value
+      if self.size < len(self._items):
+        self._items.popitem(last=False)
+    finally:
+      self._lock.release()
+    return value
+
+  def clear(self):
+    self._lock.acquire()
+    try:
+      self._items.clear()
+    finally:
+      self._lock.release()
+    return
+
 # decode RFC header
-decode_header = Header.decode_header
-def unicode_header(s):
+def decode_header(s):
+  return Header.decode_header(s)
+def _unicode_header(s):
   try:
     return u' '.join( unicode(s1,t1 or 'ascii','replace') for (s1,t1) in decode_header(s) )
   except LookupError:
@@ -135,6 +413,15 @@ def unicode_header(s):
   except Header.HeaderParseError:
     return unicode(s, 'ascii', 'replace')
 
+HEADER_CACHE = LRUCache(4096)
+def unicode_header(s):
+  if not isinstance(s, str):
+    return _unicode_header(s)
+  if '=?' not in s:
+    # Nothing is encoded.
+    return unicode(s, 'ascii', 'replace')
+  return HEADER_CACHE.get(s, _unicode_header)
+
 # getall
 def unicode_getall(msg, h):
   return [ unicode_header(s) for s in msg.get_all(h, []) ]
@@ -185,9 +472,12 @@ def validate_message_headers(msg, check_subject):
 
 ##  Logging
 ##
-LOG_FP = config.LOG_FILE and file(config.LOG_FILE, 'a')
+LOG_FP = None
 def log(x):
-  if not LOG_FP: return
+  global LOG_FP
+  if not config.LOG_FILE: return
+  if LOG_FP == None:
+    LOG_FP = file(config.LOG_FILE, 'a')
   if not isinstance(x, str):
     x = repr(x)
   LOG_FP.write('%s: %d: %s\n' % (time.asctime(), os.getpid(), x))